@@ -1,5 +1,9 @@
+import heapq
+
 class Series:
 
+    COUNTING_RANGE = 256
+
     @staticmethod
     def __check_data(data):
         if type(data) != list:
@@ -88,6 +92,88 @@ class Series:
     
     def __repr__(self) -> str:
         return ', '.join(map(str, self.data))
+
+    @staticmethod
+    def __sort_check(ascending, na_position):
+        if type(ascending) != bool:
+            raise ValueError("The given ascending flag is not of type bool!")
+        if na_position != 'first' and na_position != 'last':
+            raise ValueError("The given na_position is neither 'first' nor 'last'!")
+
+    @staticmethod
+    def __counting_sort(positions, keys):
+        top = max(keys[i] for i in positions) if positions else 0
+        if top <= 1:
+            return [i for i in positions if not keys[i]] + [i for i in positions if keys[i]]
+        buckets = [[] for _ in range(top + 1)]
+        append = [bucket.append for bucket in buckets]
+        for i in positions:
+            append[keys[i]](i)
+        return [i for bucket in buckets for i in bucket]
+
+    def __valid_positions(self):
+        nulls = []
+        valid = []
+        for i, elem in enumerate(self.data):
+            if elem == None or elem != elem:
+                nulls.append(i)
+            else:
+                valid.append(i)
+        return valid, nulls
+
+    def take(self, positions):
+        data = []
+        for i in positions:
+            if type(i) != int or i < -len(self) or i >= len(self):
+                raise ValueError("The given positions are not valid integer positions of the Series!")
+            data.append(self.data[i])
+        return Series(data)
+
+    def argsort(self, ascending = True, na_position = 'last'):
+        Series.__sort_check(ascending, na_position)
+        valid, nulls = self.__valid_positions()
+
+        low = high = 0
+        if (self.type == int or self.type == bool) and valid:
+            low = min(int(self.data[i]) for i in valid)
+            high = max(int(self.data[i]) for i in valid)
+
+        if (self.type == int or self.type == bool) and high - low < Series.COUNTING_RANGE:
+            keys = [0] * len(self)
+            for i in valid:
+                keys[i] = int(self.data[i]) - low if ascending else high - int(self.data[i])
+            order = Series.__counting_sort(valid, keys)
+        else:
+            order = sorted(valid, key = self.data.__getitem__, reverse = not ascending)
+
+        if na_position == 'first':
+            return Series(nulls + order)
+        return Series(order + nulls)
+
+    def sort_values(self, ascending = True, na_position = 'last'):
+        return self.take(self.argsort(ascending, na_position).data)
+
+    def __top(self, n, largest):
+        if type(n) != int or n < 0:
+            raise ValueError("The given number of elements is not a non-negative integer!")
+        if self.type == None:
+            return []
+        valid, nulls = self.__valid_positions()
+        if largest:
+            return heapq.nlargest(n, valid, key = self.data.__getitem__)
+        return heapq.nsmallest(n, valid, key = self.data.__getitem__)
+
+    def nlargest(self, n):
+        return self.take(self.__top(n, True))
+
+    def nsmallest(self, n):
+        return self.take(self.__top(n, False))
+
+    def nlargest_positions(self, n):
+        return Series(self.__top(n, True))
+
+    def nsmallest_positions(self, n):
+        return Series(self.__top(n, False))
     
 class SeriesBool(Series):
 
@@ -550,6 +636,43 @@ class DataFrame:
     def __len__(self):
         for key in self.data:
             return len(self.data[key])
+        return 0
+
+    def take(self, positions):
+        data = {}
+        for index, value in self.data.items():
+            data[index] = value.take(positions)
+        return DataFrame(data)
+
+    def sort_by(self, columns, ascending = True, na_position = 'last'):
+        if type(columns) == str:
+            columns = [columns]
+        if type(columns) != list or len(columns) == 0:
+            raise ValueError("The given columns are not a str or a non-empty list of str!")
+        for column in columns:
+            if column not in self.data:
+                raise ValueError("The given column " + str(column) + " is not in the DataFrame!")
+
+        if type(ascending) == bool:
+            ascending = [ascending] * len(columns)
+        if type(ascending) != list or len(ascending) != len(columns):
+            raise ValueError("The given ascending flags are not a bool or a list of the same length as the columns!")
+
+        order = list(range(len(self)))
+        for column, asc in zip(reversed(columns), reversed(ascending)):
+            permutation = self.data[column].take(order).argsort(asc, na_position).data
+            order = [order[i] for i in permutation]
+        return self.take(order)
+
+    def nlargest(self, n, column):
+        if column not in self.data:
+            raise ValueError("The given column " + str(column) + " is not in the DataFrame!")
+        return self.take(self.data[column].nlargest_positions(n).data)
+
+    def nsmallest(self, n, column):
+        if column not in self.data:
+            raise ValueError("The given column " + str(column) + " is not in the DataFrame!")
+        return self.take(self.data[column].nsmallest_positions(n).data)
     
     def __repr__(self):
         string = "DataFrame \n" 
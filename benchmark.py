@@ -0,0 +1,215 @@
+# -*- coding: utf-8 -*-
+"""
+Throughput benchmarks of the simulations and of QuantCo with regression tracking
+"""
+import numpy as np
+import json
+import os
+import platform
+import sys
+import time
+import tracemalloc
+
+import QuantCo
+import double_pendulum
+import epidemic
+import gravitation
+import particle_simulation
+
+#every case is (name, unit, sizes, setup, run, work): setup(n) builds the state outside of the timing,
+#run(state) is timed and work(n) is the number of units it processes, e.g. integration steps or rows
+
+def pendulum_setup(n):
+    theta, alpha = np.random.default_rng(0).uniform(-np.pi, np.pi, (2, n))
+    if n == 1:
+        return double_pendulum.Pendulum(0.01, 1., 9.81, theta[0], alpha[0], 0., 0.)
+    return double_pendulum.PendulumBatch(0.01, 1., 9.81, theta, alpha)
+
+def pendulum_run(method, steps=200):
+    def run(pendel):
+        for i in range(steps):
+            getattr(pendel, method)()
+    return run
+
+def mass_setup(n):
+    G, M, r = 6.6743 * 10**-20, 5.9723 * 10**24, 7000
+    return gravitation.mass(1., 1., G*M, 1., r, 0., np.pi/2, 0., 2*np.sqrt(G*M/r**3), 0.)
+
+def mass_run(sat, steps=2000):
+    for i in range(steps):
+        sat.velocity_verlet()
+
+def epidemic_setup(n):
+    #same density as the epidemic script, 300 particles in a 100 x 100 box
+    np.random.seed(0)
+    box = np.array([100, 100]) * np.sqrt(n / 300)
+    x = epidemic.place_particles(n, box)
+    v = np.random.normal(0, 3, size=(2, n))
+    sim = epidemic.Simulation(1000, 0.001, x, v, box, 8, 0.1, 0.5, 0.15)
+    sim.vv_step()
+    return sim
+
+def epidemic_run(sim, steps=20):
+    for i in range(steps):
+        sim.vv_step()
+
+def particle_parameters(values):
+    #set module parameters of particle_simulation and return their previous values
+    previous = {key: getattr(particle_simulation, key) for key in values}
+    for key, value in values.items():
+        setattr(particle_simulation, key, value)
+    return previous
+
+def particle_setup(n):
+    #the script's module parameters at the density of its default of 100 particles in a 10 x 10 box,
+    #they are only set while the particles are created and while the pass runs
+    width = 10. * np.sqrt(n / 100)
+    values = {'N_PARTICLES': n, 'WIDTH': width, 'HEIGHT': width}
+    previous = particle_parameters(values)
+    try:
+        rng = particle_simulation.RandomStream(0)
+        return particle_simulation.initialize_particles(rng) + (rng, values)
+    finally:
+        particle_parameters(previous)
+
+def particle_run(state):
+    positions, velocities, is_red, cooldown, rng, values = state
+    previous = particle_parameters(values)
+    try:
+        i, j, delta = particle_simulation.find_collision_pairs(positions)
+        particle_simulation.handle_collisions(i, j, delta, velocities, is_red, cooldown, rng)
+    finally:
+        particle_parameters(previous)
+
+def series_setup(n):
+    rng = np.random.default_rng(0)
+    a = rng.integers(0, 1000, n)
+    return (QuantCo.Series(a.tolist()), QuantCo.Series((a[::-1] + 1).tolist()),
+            QuantCo.Series((a / 7).tolist()), QuantCo.Series((a % 3 == 0).tolist()))
+
+def dataframe_setup(n):
+    ints, ints2, floats, mask = series_setup(n)
+    return QuantCo.DataFrame({'a': ints, 'b': floats, 'c': ints2}), mask
+
+def cases(max_rows=10**7):
+    rows = [n for n in (10**3, 10**4, 10**5, 10**6, 10**7) if n <= max_rows]
+    return [
+        ('pendulum_runge_kutta', 'steps', [1, 100, 10000], pendulum_setup, pendulum_run('runge_kutta'),
+         lambda n: 200 * n),
+        ('pendulum_velocity_verlet', 'steps', [1, 100, 10000], pendulum_setup, pendulum_run('velocity_verlet'),
+         lambda n: 200 * n),
+        ('mass_velocity_verlet', 'steps', [1], mass_setup, mass_run, lambda n: 2000),
+        ('epidemic_vv_step', 'steps', [100, 300, 1000], epidemic_setup, epidemic_run, lambda n: 20),
+        ('particle_collisions', 'particles', [10**2, 10**3, 10**4, 10**5], particle_setup, particle_run,
+         lambda n: n),
+        ('series_int_add', 'rows', rows, series_setup, lambda s: s[0] + s[1], lambda n: n),
+        ('series_float_mul', 'rows', rows, series_setup, lambda s: s[2] * 0.5, lambda n: n),
+        ('series_compare', 'rows', rows, series_setup, lambda s: s[0] < s[1], lambda n: n),
+        ('series_filter', 'rows', rows, series_setup, lambda s: s[2][s[3]], lambda n: n),
+        ('dataframe_mask', 'rows', rows, dataframe_setup, lambda s: s[0][s[1]], lambda n: n),
+    ]
+
+def measure(setup, run, n, repeat):
+    #best wall time of repeat runs on fresh states, then the peak of the memory allocated by one run,
+    #the state is built before tracing starts, so only the measured operation counts
+    seconds = np.inf
+    for i in range(repeat):
+        state = setup(n)
+        start = time.perf_counter()
+        run(state)
+        seconds = min(seconds, time.perf_counter() - start)
+        del state
+
+    state = setup(n)
+    tracemalloc.start()
+    run(state)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return seconds, peak
+
+def run_benchmarks(max_rows=10**7, repeat=3, only=None, log=print):
+    results = {}
+    for name, unit, sizes, setup, run, work in cases(max_rows):
+        if only is not None and name not in only:
+            continue
+        points = []
+        for n in sizes:
+            seconds, peak = measure(setup, run, n, repeat)
+            points.append({'n': n, 'seconds': seconds, 'rate': work(n) / seconds, 'peak_bytes': peak})
+            log('%-26s n = %-9d %12.4g s %14.4g %s/s %10.1f MB' % (name, n, seconds, work(n) / seconds,
+                                                                   unit, peak / 2**20))
+
+        #exponent of the time against the size from a least squares fit in log-log scale
+        exponent = None
+        if len(points) > 1:
+            n, seconds = np.array([[p['n'], p['seconds']] for p in points]).T
+            exponent = float(np.polyfit(np.log(n), np.log(seconds), 1)[0])
+        results[name] = {'unit': unit, 'points': points, 'exponent': exponent}
+    return results
+
+def environment():
+    return {'python': sys.version.split()[0], 'numpy': np.__version__, 'platform': platform.platform(),
+            'processor': platform.processor(), 'cpus': os.cpu_count(),
+            'date': time.strftime('%Y-%m-%d %H:%M:%S')}
+
+def compare(results, baseline, tolerance=0.25, memory_floor=2**16):
+    #regressions are points slower than the baseline by more than the relative tolerance, or allocating more
+    #by the tolerance and by at least memory_floor bytes, points missing in either run are ignored
+    regressions = []
+    for name, result in results.items():
+        if name not in baseline:
+            continue
+        reference = {p['n']: p for p in baseline[name]['points']}
+        for point in result['points']:
+            if point['n'] not in reference:
+                continue
+            ratio = point['seconds'] / reference[point['n']]['seconds']
+            memory = point['peak_bytes'] / max(reference[point['n']]['peak_bytes'], 1)
+            grown = point['peak_bytes'] - reference[point['n']]['peak_bytes'] > memory_floor
+            if ratio > 1 + tolerance or (memory > 1 + tolerance and grown):
+                regressions.append('%-26s n = %-9d time x%.2f  memory x%.2f' % (name, point['n'], ratio, memory))
+    return regressions
+
+def save(filename, results):
+    with open(filename + '.tmp', 'w') as file:
+        json.dump({'environment': environment(), 'results': results}, file, indent=1)
+    os.replace(filename + '.tmp', filename)
+
+def load(filename):
+    with open(filename) as file:
+        return json.load(file)['results']
+
+
+if __name__ == '__main__':
+    #largest QuantCo series, the pure python columns of 10**7 rows need a few GB and minutes per case
+    max_rows = 10**7
+
+    #timed runs per point, the best one counts
+    repeat = 3
+
+    #names of the cases to run, None runs all of them
+    only = None
+
+    #results of this run and the stored baseline it is compared to
+    output = 'benchmark.json'
+    baseline_file = 'benchmark_baseline.json'
+
+    #relative slow down of time or peak memory which counts as regression
+    tolerance = 0.25
+
+    #store this run as the new baseline
+    update_baseline = False
+
+    results = run_benchmarks(max_rows, repeat, only)
+    save(output, results)
+
+    if update_baseline or not os.path.exists(baseline_file):
+        save(baseline_file, results)
+        print('baseline written to ' + baseline_file)
+    else:
+        regressions = compare(results, load(baseline_file), tolerance)
+        for line in regressions:
+            print('regression: ' + line)
+        if not regressions:
+            print('no regressions against ' + baseline_file)
+        sys.exit(1 if regressions else 0)
@@ -0,0 +1,115 @@
+# -*- coding: utf-8 -*-
+"""
+Streaming diagnostics for long running animations
+"""
+import numpy as np
+
+class EnergyMonitor:
+    def __init__(self, size=512, filename=None, buffer=4096):
+        #running statistics of a stream (t, e) in O(1) per update and a min/max decimated history of
+        #at most 2*size points for plotting, optionally every sample is written to filename as float64 pairs,
+        #an existing file is overwritten and the buffered samples are only complete on disk after close
+        self.size = size + size % 2
+        self.count = 0
+        self.min = np.inf
+        self.max = -np.inf
+        self.mean = 0.
+        self.m2 = 0.
+        self.first = None
+        self.last = None
+        self.max_drift = 0.
+
+        #every bucket covers stride samples and keeps time and value of their minimum and maximum,
+        #when all buckets are full neighbours are merged and the stride doubles
+        self.stride = 1
+        self.buckets = np.empty((self.size, 4))
+        self.n_buckets = 0
+        self.fill = 0
+
+        self.file = open(filename, 'wb') if filename is not None else None
+        self.spill = np.empty((buffer, 2))
+        self.n_spill = 0
+
+    def update(self, t, e):
+        e = float(e)
+        self.count += 1
+        self.min = min(self.min, e)
+        self.max = max(self.max, e)
+        delta = e - self.mean
+        self.mean += delta / self.count
+        self.m2 += delta * (e - self.mean)
+        if self.first is None:
+            self.first = e
+        self.last = e
+        self.max_drift = max(self.max_drift, abs(self.drift()))
+
+        if self.fill == 0:
+            if self.n_buckets == self.size:
+                self.merge()
+            self.buckets[self.n_buckets] = t, e, t, e
+            self.n_buckets += 1
+        else:
+            bucket = self.buckets[self.n_buckets - 1]
+            if e < bucket[1]:
+                bucket[0:2] = t, e
+            if e > bucket[3]:
+                bucket[2:4] = t, e
+        self.fill = (self.fill + 1) % self.stride
+
+        if self.file is not None:
+            self.spill[self.n_spill] = t, e
+            self.n_spill += 1
+            if self.n_spill == len(self.spill):
+                self.flush()
+
+    def merge(self):
+        #pairs of buckets become one, keeping the smaller minimum and the larger maximum
+        a, b = self.buckets[0::2], self.buckets[1::2]
+        merged = np.where((b[:, 1] < a[:, 1])[:, None], np.c_[b[:, 0:2], a[:, 2:4]], a)
+        merged[:, 2:4] = np.where((b[:, 3] > merged[:, 3])[:, None], b[:, 2:4], merged[:, 2:4])
+        self.n_buckets = len(merged)
+        self.buckets[:self.n_buckets] = merged
+        self.stride *= 2
+
+    def history(self):
+        #decimated curve, minimum and maximum of every bucket in the order of their times
+        buckets = self.buckets[:self.n_buckets]
+        first_min = buckets[:, 0] <= buckets[:, 2]
+        t = np.where(first_min[:, None], buckets[:, [0, 2]], buckets[:, [2, 0]]).ravel()
+        e = np.where(first_min[:, None], buckets[:, [1, 3]], buckets[:, [3, 1]]).ravel()
+        return t, e
+
+    def drift(self):
+        #relative change of the last value against the first one
+        if self.first is None or self.first == 0:
+            return 0.
+        return (self.last - self.first) / abs(self.first)
+
+    def std(self):
+        return np.sqrt(self.m2 / self.count) if self.count > 0 else 0.
+
+    def limits(self, margin=0.01):
+        #axis limits around everything seen so far, never empty
+        pad = max(self.max - self.min, margin * max(abs(self.max), abs(self.min)), margin) * 0.05
+        return self.min - pad, self.max + pad
+
+    def flush(self):
+        if self.file is not None and self.n_spill > 0:
+            self.spill[:self.n_spill].tofile(self.file)
+            self.file.flush()
+            self.n_spill = 0
+
+    def close(self):
+        self.flush()
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+    def summary(self):
+        return ('samples %d  min %.10g  max %.10g  mean %.10g  std %.3e  drift %.3e  max drift %.3e'
+                % (self.count, self.min, self.max, self.mean, self.std(), self.drift(), self.max_drift))
+
+
+def load_energy(filename):
+    #full resolution stream written by EnergyMonitor as columns t, e
+    return np.fromfile(filename, dtype=np.float64).reshape(-1, 2)
@@ -6,8 +6,11 @@ Created on Mon Apr 13 20:20:40 2020
 """
 
 import numpy as np
+import multiprocessing
+import os
 import matplotlib.pyplot as plt
 import matplotlib.animation as animation
+from diagnostics import EnergyMonitor
 
 class Pendulum:
     def __init__(self, dt, T, g, theta0, alpha0, theta1, alpha1):
@@ -21,6 +24,14 @@ class Pendulum:
         self.alpha_v = alpha1
         self.E = self.energy()
 
+        #state of the adaptive dormand-prince integrator: tolerances, step size, the step (t0, y0, h, K)
+        #containing the current time for dense output and the last state it handed out
+        self.rtol = 1e-8
+        self.atol = 1e-10
+        self.h = dt
+        self.step = None
+        self.dense = None
+
     def euler_ex(self):
         theta_old = self.theta
         alpha_old = self.alpha
@@ -70,6 +81,58 @@ class Pendulum:
         self.alpha_v += 0.5*self.dt*alpha_a
         self.t += self.dt
 
+    def rhs(self, y):
+        theta_a, alpha_a = self.eq_motion(y[0], y[1], y[2], y[3])
+        return np.array([y[2], y[3], theta_a, alpha_a])
+
+    def dormand_prince(self, t0, y0, f0):
+        #adaptive dormand-prince 5(4) step from t0, the step size is reduced until the error estimate
+        #is within the tolerances and the proposal for the next step is kept in self.h
+        while True:
+            h = self.h
+            K = [f0]
+            for c, a in zip(DP_C[1:], DP_A[1:]):
+                K.append(self.rhs(y0 + h * sum(a_j * k for a_j, k in zip(a, K))))
+            y1 = y0 + h * sum(b * k for b, k in zip(DP_B, K))
+            K.append(self.rhs(y1))
+
+            error = h * sum(e * k for e, k in zip(DP_E, K))
+            scale = self.atol + self.rtol * np.maximum(np.abs(y0), np.abs(y1))
+            #rms over the state of every pendulum, the worst pendulum of a batch decides
+            norm = np.max(np.sqrt(np.mean((error / scale)**2, axis=0)))
+            factor = 5. if norm == 0 else min(5., max(0.2, 0.9 * norm**-0.2))
+            self.h = h * factor
+            if norm <= 1:
+                return t0 + h, y1, h, np.array(K)
+
+    def advance_to(self, t):
+        #integrate with adaptive steps up to the time t and set the state by dense output at t,
+        #the last right-hand side of a step is the first of the next one, so sampling costs no evaluations
+        y = np.array([self.theta, self.alpha, self.theta_v, self.alpha_v])
+        if self.dense is None or self.dense[0] != self.t or not np.array_equal(self.dense[1], y):
+            #the state was changed by another integrator or by hand, restart from it
+            self.step = (self.t, y, self.t, y, np.array([self.rhs(y)] * 7))
+
+        t0, y0, t1, y1, K = self.step
+        while t1 < t:
+            t0, y0 = t1, y1
+            t1, y1, h, K = self.dormand_prince(t0, y0, K[-1])
+        self.step = (t0, y0, t1, y1, K)
+
+        y = self.interpolate(t)
+        self.theta, self.alpha, self.theta_v, self.alpha_v = y
+        self.t = t
+        self.dense = (t, y)
+
+    def interpolate(self, t):
+        #fourth order continuous extension of the current step
+        t0, y0, t1, y1, K = self.step
+        if t1 == t0:
+            return y0
+        h = t1 - t0
+        sigma = (t - t0) / h
+        return y0 + h * np.tensordot(DP_P @ np.cumprod([sigma] * 4), K, axes=(0, 0))
+
     def eq_motion(self, theta, alpha, theta_v, alpha_v):
         theta_a = (self.g * (-2*np.sin(theta) + np.sin(theta + alpha) * np.cos(alpha))
                    + np.sin(alpha) * ((np.cos(alpha) + 1) * theta_v**2
@@ -90,26 +153,313 @@ class Pendulum:
         return [x0,x1], [y0,y1]
 
 
+class PendulumBatch(Pendulum):
+    def __init__(self, dt, T, g, theta0, alpha0, theta1=0., alpha1=0.):
+        #many pendulums at once, the angles and velocities are arrays and the fixed step integrators
+        #of Pendulum advance all of them in every step
+        state = np.broadcast_arrays(*[np.array(a, dtype=float) for a in (theta0, alpha0, theta1, alpha1)])
+        theta0, alpha0, theta1, alpha1 = [a.ravel().copy() for a in state]
+        super().__init__(dt, T, g, theta0, alpha0, theta1, alpha1)
+        self.shape = state[0].shape
+
+    def retire(self, keep):
+        #drop the finished pendulums from the active set
+        self.theta, self.alpha = self.theta[keep], self.alpha[keep]
+        self.theta_v, self.alpha_v = self.theta_v[keep], self.alpha_v[keep]
+
+    def flip_times(self, method='runge_kutta'):
+        #time until the lower arm first flips, i.e. its absolute angle theta + alpha passes an odd multiple
+        #of pi, pendulums which can't flip with their energy and those not flipping before T get nan,
+        #the integrators advance the batch itself, so its full state is put back afterwards
+        state = (self.t, self.theta, self.alpha, self.theta_v, self.alpha_v)
+        times = np.full(self.theta.shape, np.nan)
+        active = np.flatnonzero(self.energy() >= -self.g)
+        self.retire(active)
+        turn = np.floor((self.theta + self.alpha + np.pi) / (2*np.pi))
+
+        while self.t < self.T and len(active) > 0:
+            getattr(self, method)()
+            flipped = np.floor((self.theta + self.alpha + np.pi) / (2*np.pi)) != turn
+            if np.any(flipped):
+                times[active[flipped]] = self.t
+                active = active[~flipped]
+                turn = turn[~flipped]
+                self.retire(~flipped)
+        self.t, self.theta, self.alpha, self.theta_v, self.alpha_v = state
+        return times.reshape(self.shape)
+
+    def tangent_rhs(self, y, V):
+        #right-hand side of the trajectories y (4, M) and of their deviation vectors V (4, n, M), the products
+        #of the jacobian of eq_motion with the deviations come from the complex step derivative, exact to rounding
+        h = 1e-20
+        dV = np.empty_like(V)
+        for k in range(V.shape[1]):
+            dV[:, k] = np.imag(self.rhs(y + 1j * h * V[:, k])) / h
+        return self.rhs(y), dV
+
+    def lyapunov(self, n_vectors=4, renorm=10, check=50, tol=1e-3):
+        #lyapunov exponents from the tangent dynamics, integrated with classical runge-kutta steps next to the
+        #trajectories and orthonormalized (gram-schmidt via qr) every renorm steps, a pendulum is retired
+        #once its estimates change by less than tol between two checks (every check renormalizations),
+        #the state of the batch is not changed
+        y = np.array([self.theta, self.alpha, self.theta_v, self.alpha_v])
+        m = y.shape[1]
+        V = np.repeat(np.eye(4)[:, :n_vectors, None], m, axis=2)
+        sums = np.zeros((n_vectors, m))
+        previous = np.full((n_vectors, m), np.inf)
+        exponents = np.full((n_vectors, m), np.nan)
+        times = np.full(m, np.nan)
+        active = np.arange(m)
+        t0 = t = self.t
+        dt = self.dt
+
+        steps = 0
+        while t < self.T and len(active) > 0:
+            f1, k1 = self.tangent_rhs(y, V)
+            f2, k2 = self.tangent_rhs(y + dt/2 * f1, V + dt/2 * k1)
+            f3, k3 = self.tangent_rhs(y + dt/2 * f2, V + dt/2 * k2)
+            f4, k4 = self.tangent_rhs(y + dt * f3, V + dt * k3)
+            y = y + dt/6 * (f1 + 2*f2 + 2*f3 + f4)
+            V = V + dt/6 * (k1 + 2*k2 + 2*k3 + k4)
+            t += dt
+            steps += 1
+
+            if steps % renorm == 0:
+                Q, R = np.linalg.qr(V.transpose(2, 0, 1))
+                sums += np.log(np.abs(np.diagonal(R, axis1=1, axis2=2))).T
+                V = Q.transpose(1, 2, 0)
+
+                if steps % (renorm * check) == 0:
+                    estimate = sums / (t - t0)
+                    done = np.all(np.abs(estimate - previous) < tol, axis=0)
+                    exponents[:, active[done]] = estimate[:, done]
+                    times[active[done]] = t
+                    keep = ~done
+                    active, y, V, sums, previous = active[keep], y[:, keep], V[..., keep], sums[:, keep], estimate[:, keep]
+
+        if len(active) > 0:
+            exponents[:, active] = sums / (t - t0)
+        return exponents.reshape((n_vectors,) + self.shape), times.reshape(self.shape)
+
+def sample_energy_shell(E, n, g, rng):
+    #n states on the section alpha = 0 with alpha_v > 0 at the energy E, theta and theta_v are drawn uniformly
+    #from the allowed region and alpha_v solves the energy equation, which is quadratic in it, alpha_v =
+    #-2*theta_v +- sqrt(2E + 6g cos(theta) - theta_v^2), the root is drawn at random, as both can be positive
+    theta_v_max = np.sqrt(max(2*E + 6*g, 0))
+    theta, theta_v, alpha_v = np.empty(0), np.empty(0), np.empty(0)
+    while len(theta) < n:
+        t = rng.uniform(-np.pi, np.pi, 4*n)
+        t_v = rng.uniform(-theta_v_max, theta_v_max, 4*n)
+        root = rng.choice([-1., 1.], 4*n)
+        D = 2*E + 6*g*np.cos(t) - t_v**2
+        a_v = -2*t_v + root * np.sqrt(np.maximum(D, 0))
+        valid = (D >= 0) & (a_v > 0)
+        theta, theta_v, alpha_v = np.append(theta, t[valid]), np.append(theta_v, t_v[valid]), np.append(alpha_v, a_v[valid])
+    return theta[:n], np.zeros(n), theta_v[:n], alpha_v[:n]
+
+#record of a section crossing: trajectory index, time, the section coordinates theta and its canonical momentum
+#p_theta = 5*theta_v + 2*alpha_v (at alpha = 0), which together identify the state on the energy shell, and theta_v
+SECTION_DTYPE = np.dtype([('trajectory', '<i4'), ('t', '<f4'), ('theta', '<f4'), ('p_theta', '<f4'),
+                          ('theta_v', '<f4')])
+
+def load_section(filename):
+    return np.fromfile(filename, dtype=SECTION_DTYPE)
+
+def poincare_section(filename, E, n, g, T, dt=0.01, seed=None, rtol=1e-9, atol=1e-11):
+    #integrate n trajectories on the energy shell E as one batch with adaptive dormand-prince steps and append
+    #their crossings of alpha = 0 mod 2pi with alpha_v > 0 to filename, the crossing times are found by
+    #bisection on the dense output of the step, so no dense sampling of the trajectories is needed
+    pendulums = PendulumBatch(dt, T, g, *sample_energy_shell(E, n, g, np.random.default_rng(seed)))
+    pendulums.rtol, pendulums.atol = rtol, atol
+    t0 = 0.
+    y0 = np.array([pendulums.theta, pendulums.alpha, pendulums.theta_v, pendulums.alpha_v])
+    f0 = pendulums.rhs(y0)
+    count = 0
+
+    with open(filename, 'wb') as file:
+        while t0 < T:
+            t1, y1, h, K = pendulums.dormand_prince(t0, y0, f0)
+            crossed = np.floor(y1[1] / (2*np.pi)) > np.floor(y0[1] / (2*np.pi))
+            if np.any(crossed):
+                k = np.flatnonzero(crossed)
+                target = 2*np.pi * np.floor(y1[1, k] / (2*np.pi))
+                lo, hi = np.zeros(len(k)), np.ones(len(k))
+                for i in range(50):
+                    mid = 0.5 * (lo + hi)
+                    below = dense_output(y0[:, k], h, K[..., k], mid)[1] < target
+                    lo, hi = np.where(below, mid, lo), np.where(below, hi, mid)
+                sigma = 0.5 * (lo + hi)
+                y = dense_output(y0[:, k], h, K[..., k], sigma)
+
+                record = np.empty(len(k), dtype=SECTION_DTYPE)
+                record['trajectory'] = k
+                record['t'] = t0 + sigma * h
+                record['theta'] = (y[0] + np.pi) % (2*np.pi) - np.pi
+                record['p_theta'] = 5*y[2] + 2*y[3]
+                record['theta_v'] = y[2]
+                record.tofile(file)
+                count += len(k)
+            t0, y0, f0 = t1, y1, K[-1]
+    return count
+
+def dense_output(y0, h, K, sigma):
+    #continuous extension of a dormand-prince step at the fractions sigma of the step, one per pendulum
+    sigma = np.asarray(sigma, dtype=float)
+    b = DP_P @ np.array([sigma, sigma**2, sigma**3, sigma**4])
+    return y0 + h * np.sum(b[:, None] * K, axis=0)
+
+def flip_time_tile(args):
+    dt, T, g, theta, alpha, method = args
+    return PendulumBatch(dt, T, g, theta, alpha).flip_times(method)
+
+def flip_time_map(thetas, alphas, dt, T, g, tile=256, workers=None, method='runge_kutta'):
+    #flip times on the grid of initial angles thetas x alphas (at rest), split into tiles for a process pool
+    theta, alpha = np.meshgrid(thetas, alphas, indexing='ij')
+    tiles = [(i, j) for i in range(0, len(thetas), tile) for j in range(0, len(alphas), tile)]
+    tasks = [(dt, T, g, theta[i:i+tile, j:j+tile], alpha[i:i+tile, j:j+tile], method) for i, j in tiles]
+    with multiprocessing.Pool(workers) as pool:
+        results = pool.map(flip_time_tile, tasks)
+
+    times = np.empty(theta.shape)
+    for (i, j), result in zip(tiles, results):
+        times[i:i+tile, j:j+tile] = result
+    return times
+
+class FlipTimeTiles:
+    def __init__(self, directory, g, dt, T, method='runge_kutta', tile=64, domain=(-np.pi, np.pi, -np.pi, np.pi),
+                 workers=None):
+        #flip time maps over the initial angles (theta, alpha) as a pyramid of tile x tile pixel tiles, level z
+        #splits the domain into 2**z x 2**z tiles, every computed tile is kept on disk in a directory per
+        #parameter set, so zooming and panning only computes the tiles which are missing
+        self.g = g
+        self.dt = dt
+        self.T = T
+        self.method = method
+        self.tile = tile
+        self.domain = domain
+        self.workers = workers
+        #the parameters are written with repr, so every float is kept exactly in the key
+        exact = [repr(float(value)) for value in (g, dt, T) + tuple(domain)]
+        self.directory = os.path.join(directory, '%s_g%s_dt%s_T%s_%dpx_%s_%s_%s_%s' % ((method,) + tuple(exact[:3])
+                                      + (tile,) + tuple(exact[3:])))
+        os.makedirs(self.directory, exist_ok=True)
+
+    def filename(self, level, i, j):
+        return os.path.join(self.directory, 'z%d_%d_%d.npy' % (level, i, j))
+
+    def grid(self, level, i, j):
+        #pixels sit at the lower corners of their cells, then every second pixel of a tile is a pixel of its
+        #parent tile one level up
+        t_min, t_max, a_min, a_max = self.domain
+        w_t, w_a = (t_max - t_min) / 2**level, (a_max - a_min) / 2**level
+        thetas = t_min + w_t * (i + np.arange(self.tile) / self.tile)
+        alphas = a_min + w_a * (j + np.arange(self.tile) / self.tile)
+        return np.meshgrid(thetas, alphas, indexing='ij')
+
+    def tiles(self, region, level):
+        #indices of the tiles at level which intersect the region (theta_min, theta_max, alpha_min, alpha_max)
+        t_min, t_max, a_min, a_max = self.domain
+        n = 2**level
+        i0, i1 = [int(np.clip(np.floor((r - t_min) / (t_max - t_min) * n), 0, n-1)) for r in region[:2]]
+        j0, j1 = [int(np.clip(np.floor((r - a_min) / (a_max - a_min) * n), 0, n-1)) for r in region[2:]]
+        return range(i0, i1+1), range(j0, j1+1)
+
+    def load(self, level, i, j):
+        filename = self.filename(level, i, j)
+        return np.load(filename) if os.path.exists(filename) else None
+
+    def compute(self, level, missing):
+        #flip times of the missing tiles of one level, the pixels shared with a cached parent tile are copied
+        #and only the others are integrated
+        times, tasks = [], []
+        half = self.tile // 2
+        for i, j in missing:
+            theta, alpha = self.grid(level, i, j)
+            result = np.full(theta.shape, np.nan)
+            todo = np.ones(theta.shape, dtype=bool)
+            parent = self.load(level-1, i//2, j//2) if level > 0 and self.tile % 2 == 0 else None
+            if parent is not None:
+                block = parent[i%2*half:(i%2+1)*half, j%2*half:(j%2+1)*half]
+                result[::2, ::2] = block
+                todo[::2, ::2] = False
+            times.append((result, todo))
+            tasks.append((self.dt, self.T, self.g, theta[todo], alpha[todo], self.method))
+
+        with multiprocessing.Pool(self.workers) as pool:
+            results = pool.map(flip_time_tile, tasks)
+
+        for (i, j), (result, todo), computed in zip(missing, times, results):
+            result[todo] = computed
+            filename = self.filename(level, i, j)
+            with open(filename + '.tmp', 'wb') as file:
+                np.save(file, result)
+            os.replace(filename + '.tmp', filename)
+
+    def progressive(self, region, level):
+        #fill the levels from the coarsest one to level and hand out the map of the region after each of
+        #them as (level, times, extent), so a view can show the coarse map while the finer one is computed
+        for z in range(level+1):
+            tiles_i, tiles_j = self.tiles(region, z)
+            missing = [(i, j) for i in tiles_i for j in tiles_j if not os.path.exists(self.filename(z, i, j))]
+            if missing:
+                self.compute(z, missing)
+
+            times = np.block([[self.load(z, i, j) for j in tiles_j] for i in tiles_i])
+            t_min, t_max, a_min, a_max = self.domain
+            w_t, w_a = (t_max - t_min) / 2**z, (a_max - a_min) / 2**z
+            extent = (t_min + w_t * tiles_i[0], t_min + w_t * (tiles_i[-1] + 1),
+                      a_min + w_a * tiles_j[0], a_min + w_a * (tiles_j[-1] + 1))
+            yield z, times, extent
+
+    def render(self, region, level):
+        for z, times, extent in self.progressive(region, level):
+            pass
+        return times, extent
+
+
+#butcher tableau of the dormand-prince 5(4) pair, the error weights and the dense output coefficients
+DP_C = [0, 1/5, 3/10, 4/5, 8/9, 1]
+DP_A = [[],
+        [1/5],
+        [3/40, 9/40],
+        [44/45, -56/15, 32/9],
+        [19372/6561, -25360/2187, 64448/6561, -212/729],
+        [9017/3168, -355/33, 46732/5247, 49/176, -5103/18656]]
+DP_B = np.array([35/384, 0, 500/1113, 125/192, -2187/6784, 11/84])
+DP_E = [71/57600, 0, -71/16695, 71/1920, -17253/339200, 22/525, -1/40]
+DP_P = np.array([
+    [1, -8048581381/2820520608, 8663915743/2820520608, -12715105075/11282082432],
+    [0, 0, 0, 0],
+    [0, 131558114200/32700410799, -68118460800/10900136933, 87487479700/32700410799],
+    [0, -1754552775/470086768, 14199869525/1410260304, -10690763975/1880347072],
+    [0, 127303824393/49829197408, -318862633887/49829197408, 701980252875/199316789632],
+    [0, -282668133/205662961, 2019193451/616988883, -1453857185/822651844],
+    [0, 40617522/29380423, -110615467/29380423, 69997945/29380423]])
+
+
 if __name__ == '__main__':
 
     def animate(j):
-        for i in range(0,int(0.01/DT)):
-            pendel.runge_kutta()
+        if adaptive:
+            pendel.advance_to(pendel.t + 0.01)
+        else:
+            for i in range(0,int(0.01/DT)):
+                pendel.runge_kutta()
 
         x, y = pendel.cartesian_coordinates()
         lines.set_xdata([0,x[0],x[1]])
         lines.set_ydata([0,y[0],y[1]])
         masses.set_offsets(np.array([x,y]).transpose())
 
-        e = pendel.energy()
-        energy.append(e)
-        line.set_xdata(np.linspace(0,pendel.t,len(energy)))
-        line.set_ydata(energy)
+        energy.update(pendel.t, pendel.energy())
+        t, e = energy.history()
+        line.set_xdata(t)
+        line.set_ydata(e)
         if pendel.t >= pendel.T:
             pendel.T *= 2
             axis.set_xlim(0, pendel.T)
 
-        axis.set_ylim(min(energy), max(energy))
+        axis.set_ylim(*energy.limits())
 
         return masses, lines, line
 
@@ -121,6 +471,8 @@ if __name__ == '__main__':
     g = 9.81
     DT = 0.01
     T = 5
+    #integrate with adaptive dormand-prince steps, DT is only the initial step size then
+    adaptive = True
 
     pendel = Pendulum(DT, T, g, theta, alpha, theta_v, alpha_v)
 
@@ -140,6 +492,12 @@ if __name__ == '__main__':
     axis = fig2.axes[0]
     axis.set_xlim(0, pendel.T)
     axis.set_ylim(e-0.01, e+0.01)
-    energy = [e]
+    #running statistics and a decimated history of the energy, energy_file keeps every sample on disk
+    energy_file = None
+    energy = EnergyMonitor(size=512, filename=energy_file)
+    energy.update(pendel.t, e)
+
+    #write the buffered energy samples when the animation window is closed
+    fig.canvas.mpl_connect('close_event', lambda event: energy.close())
 
     ani = animation.FuncAnimation(fig, animate, interval=10, blit=True)
\ No newline at end of file
@@ -1,15 +1,29 @@
 import numpy as np
-import matplotlib.pyplot as plt
-import matplotlib.animation as animation
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from PIL import Image, GifImagePlugin
+import multiprocessing
+import heapq
+import collections
+import subprocess
+import shutil
 import time
+import os
+import math
 
 np.random.seed(0)
 
+#disease states of the particles, also the colour index of the animation
+SUSCEPTIBLE, INFECTED, RECOVERED = 0, 1, 2
+
 class Simulation:
-    def __init__(self, Time, dt, x, v, box, duration, rate, skin, fixed_rate=0, fmax=float('nan')):
+    def __init__(self, Time, dt, x, v, box, duration, rate, skin, fixed_rate=0, fmax=float('nan'),
+                 checkpoint_file=None, checkpoint_interval=0, adaptive=False, dx_max=0.04, dt_max=0.05,
+                 energy_tol=1e-3):
         self.T_MAX = Time
         self.dt = dt
         self.t = 0
+        self.steps = 0
         self.x = x.copy()
         self.v = v.copy()
         self.box = box.copy()
@@ -24,9 +38,17 @@ class Simulation:
         self.verlet = []
         self.skin = skin
 
-        self.infected = np.zeros(self.n)
+        #disease state and infection time of every particle, a min-heap of (infection time, particle) for the
+        #recoveries and counters of the cases and recoveries, set by reset
+        self.state = np.zeros(self.n, dtype=np.int8)
+        self.infection_time = np.zeros(self.n)
+        self.recovery = []
+        self.n_cases = 0
+        self.n_recovered = 0
+        self.journal = None
         self.duration = duration
         self.rate = rate
+        self.fixed_rate = fixed_rate
         self.fixed = np.array(np.where(np.random.random((1, self.n))<fixed_rate, 0, 1))
         self.fixed = np.repeat(self.fixed, self.dim, axis=0)
 
@@ -34,6 +56,24 @@ class Simulation:
         self.recovered = []
         self.end = False
 
+        #adaptive time stepping: the step size is bounded by dt_max and by the maximum displacement dx_max
+        #of a particle, steps changing the energy by more than energy_tol (relative) are repeated
+        self.adaptive = adaptive
+        self.dx_max = dx_max
+        self.dt_max = dt_max
+        self.dt_min = 1e-3 * dt
+        self.dt0 = dt
+        self.step_dt = dt
+        self.energy_cache = None
+        self.energy_tol = energy_tol
+
+        #optional per-phase timing, see enable_profiling
+        self.profiler = None
+
+        #write a checkpoint every checkpoint_interval steps (0 disables it)
+        self.checkpoint_file = checkpoint_file
+        self.checkpoint_interval = checkpoint_interval
+
         self.reset()
         self.update_verlet()
         self.update_force()
@@ -48,32 +88,210 @@ class Simulation:
 
     def vv_step(self):
         #velocity verlet integration step
-        self.x = self.x + np.where(self.fixed != 0, self.dt*self.v + 0.5 * self.f * self.dt**2, 0)
-        self.v = self.v + 0.5 * self.dt * self.f
-        self.update_force()
-        self.v = self.v + 0.5 * self.dt * self.f
-
-        #increase time
-        self.t += self.dt
+        if self.adaptive:
+            self.adaptive_integrate()
+        else:
+            self.integrate(self.dt)
 
         if np.max(np.linalg.norm(self.x - self.x0, axis=0)) > 0.5 * self.skin:
             self.update_verlet()
 
         self.update_disease()
 
+        self.reflect()
+
+        self.steps += 1
+        if self.profiler is not None:
+            self.profiler.step(self)
+        if self.checkpoint_file and self.checkpoint_interval > 0 and self.steps % self.checkpoint_interval == 0:
+            self.save_checkpoint(self.checkpoint_file)
+
+    def reflect(self):
         #elastic wall boundary conditions
         for i in range(self.dim):
             self.v[i,:] *= np.where(np.abs(self.x[i,:])>=(self.box[i]/2), -1, 1)
 
+    def enable_profiling(self, interval=1000):
+        #time the phases of vv_step by wrapping the methods of this instance,
+        #so a simulation without profiling runs the unwrapped methods
+        self.profiler = Profiler(interval)
+        for phase in ['update_force', 'update_verlet', 'update_disease', 'reflect']:
+            setattr(self, phase, self.profiler.wrap(phase, getattr(self, phase)))
+
+    def integrate(self, dt):
+        self.step_dt = dt
+        self.x = self.x + np.where(self.fixed != 0, dt*self.v + 0.5 * self.f * dt**2, 0)
+        self.v = self.v + 0.5 * dt * self.f
+        self.update_force()
+        self.v = self.v + 0.5 * dt * self.f
+
+        #increase time
+        self.t += dt
+
+    def adaptive_integrate(self):
+        #the step size is bounded by a quarter of the skin travelled at the maximum speed, by the time a pair
+        #needs to close its gap to the interaction range plus dx_max and by the current maximum force
+        v = self.v * self.fixed
+        v_max = np.max(np.linalg.norm(v, axis=0))
+        f_max = np.max(np.linalg.norm(self.f * self.fixed, axis=0))
+        dt = self.dt_max
+        if v_max > 0:
+            dt = min(dt, 0.25 * self.skin / v_max)
+        if f_max > 0:
+            dt = min(dt, np.sqrt(2 * self.dx_max / f_max))
+
+        #rebuild the verlet list ahead of time if the step could carry a particle out of its skin,
+        #so that no pair outside the list can reach the interaction range during the step
+        if np.max(np.linalg.norm(self.x - self.x0, axis=0)) + v_max * dt > 0.5 * self.skin:
+            self.update_verlet()
+
+        if len(self.verlet) > 0:
+            pairs = np.asarray(self.verlet)
+            r = np.linalg.norm(self.x[:, pairs[:, 1]] - self.x[:, pairs[:, 0]], axis=0)
+            v_rel = np.linalg.norm(v[:, pairs[:, 1]] - v[:, pairs[:, 0]], axis=0)
+            with np.errstate(divide='ignore'):
+                dt = min(dt, np.min((np.maximum(r - 1, 0) + self.dx_max) / v_rel))
+
+        #the capped warm-up forces are not conservative, so the energy is only checked afterwards
+        check = np.isnan(self.fmax)
+        if check:
+            #the energy after the last accepted step is reused, reflections and disease updates don't change it
+            if self.energy_cache is not None and self.energy_cache[0] == self.steps:
+                e0 = self.energy_cache[1]
+            else:
+                e0 = self.energy()
+            state = (self.x, self.v, self.f, self.t, np.random.get_state())
+            self.journal = []
+
+        while True:
+            self.integrate(dt)
+            if not check or dt <= self.dt_min:
+                break
+            e1 = self.energy()
+            if abs(e1 - e0) <= self.energy_tol * max(abs(e0), 1.):
+                self.energy_cache = (self.steps + 1, e1)
+                break
+
+            #reject the step and retry with half the step size, infections drawn during the step are undone,
+            #their heap entries are stale now and skipped by update_disease
+            self.x, self.v, self.f, self.t, rng = state
+            for i in self.journal:
+                self.state[i] = SUSCEPTIBLE
+                self.n_cases -= 1
+            self.journal = []
+            np.random.set_state(rng)
+            dt *= 0.5
+
+        self.journal = None
+        self.dt = dt
+
+    def energy(self):
+        #kinetic energy of the moving particles plus the potential 12/11*(r^-11 - 1) of the overlapping pairs
+        kinetic = 0.5 * (self.fixed * self.v**2).sum()
+        if len(self.verlet) == 0:
+            return kinetic
+        pairs = np.asarray(self.verlet)
+        r = np.linalg.norm(self.x[:, pairs[:, 1]] - self.x[:, pairs[:, 0]], axis=0)
+        r = r[r < 1]
+        return kinetic + (12/11 * (np.power(r, -11) - 1)).sum()
+
+    def save_checkpoint(self, filename):
+        #write the full simulation state including the rng state to a compressed binary file,
+        #the pair distance matrix is not stored since it is rebuilt from x before every use
+        rng = np.random.get_state()
+        state = dict(T_MAX=self.T_MAX, dt=self.dt, dt0=self.dt0, step_dt=self.step_dt, t=self.t, steps=self.steps, fmax=self.fmax,
+                     x=self.x, v=self.v, f=self.f, x0=self.x0, box=self.box, skin=self.skin,
+                     verlet=np.asarray(self.verlet, dtype=np.int64).reshape(-1, 2),
+                     state=self.state, infection_time=self.infection_time, fixed=self.fixed, fixed_rate=self.fixed_rate,
+                     duration=self.duration, rate=self.rate, adaptive=self.adaptive,
+                     cases=np.array(self.cases, dtype=np.int64), recovered=np.array(self.recovered, dtype=np.int64),
+                     end=self.end, rng_keys=rng[1], rng_pos=rng[2], rng_has_gauss=rng[3], rng_gauss=rng[4])
+
+        #write to a temporary file first, so a preemption during the write keeps the old checkpoint intact
+        tmp = filename + '.tmp'
+        with open(tmp, 'wb') as file:
+            np.savez_compressed(file, **state)
+        os.replace(tmp, filename)
+
+    def checkpoint_mismatch(self, filename):
+        #names of the parameters of this simulation which differ from the ones stored in the checkpoint,
+        #parameters missing in older checkpoints are not compared
+        current = dict(T_MAX=self.T_MAX, dt0=self.dt0, box=self.box, skin=self.skin, duration=self.duration,
+                       rate=self.rate, fixed_rate=self.fixed_rate, adaptive=self.adaptive)
+        with np.load(filename) as data:
+            mismatch = [] if data['x'].shape == self.x.shape else ['N']
+            for key, value in current.items():
+                if key in data and not np.array_equal(data[key], value):
+                    mismatch.append(key)
+        return mismatch
+
+    def load_checkpoint(self, filename):
+        #restore the simulation state written by save_checkpoint
+        with np.load(filename) as data:
+            self.T_MAX = data['T_MAX'].item()
+            self.dt = data['dt'].item()
+            self.dt0 = data['dt0'].item()
+            self.step_dt = data['step_dt'].item()
+            self.t = data['t'].item()
+            self.steps = int(data['steps'])
+            self.fmax = data['fmax'].item()
+            self.x = data['x']
+            self.v = data['v']
+            self.f = data['f']
+            self.x0 = data['x0']
+            self.box = data['box']
+            self.skin = data['skin'].item()
+            self.verlet = data['verlet']
+            if 'state' in data:
+                self.state = data['state']
+                self.infection_time = data['infection_time']
+            else:
+                #checkpoint with the former float encoding: -1 susceptible, -2 recovered, else infection time
+                infected = data['infected']
+                self.state = np.where(infected >= 0, INFECTED, np.where(infected == -2, RECOVERED, SUSCEPTIBLE))
+                self.state = self.state.astype(np.int8)
+                self.infection_time = np.maximum(infected, 0)
+            self.fixed = data['fixed']
+            self.duration = data['duration'].item()
+            self.rate = data['rate'].item()
+            self.cases = list(data['cases'])
+            self.recovered = list(data['recovered'])
+            self.end = bool(data['end'])
+            np.random.set_state(('MT19937', data['rng_keys'], int(data['rng_pos']),
+                                 int(data['rng_has_gauss']), float(data['rng_gauss'])))
+
+        self.dim = self.x.shape[0]
+        self.n = self.x.shape[1]
+        self.energy_cache = None
+
+        #the recovery queue and the counters follow from the states
+        infected = np.flatnonzero(self.state == INFECTED)
+        self.recovery = list(zip(self.infection_time[infected], infected))
+        heapq.heapify(self.recovery)
+        self.n_cases = int(np.count_nonzero(self.state != SUSCEPTIBLE))
+        self.n_recovered = int(np.count_nonzero(self.state == RECOVERED))
+        self.journal = None
+
+    def infect(self, i):
+        self.state[i] = INFECTED
+        self.infection_time[i] = self.t
+        heapq.heappush(self.recovery, (self.t, i))
+        self.n_cases += 1
+        if self.journal is not None:
+            self.journal.append(i)
+
     def update_disease(self):
-        #check for cured cases
-        self.infected = np.where((self.t-self.duration > self.infected) & (self.infected >= 0), -2, self.infected)
-        #save amount of cases
-        self.cases.append(np.where(sim.infected != -1, 1, 0).sum())
-        #save amount of recovered cases
-        self.recovered.append(np.where(sim.infected == -2, 1, 0).sum())
-
-        if self.recovered[-1] == self.n:
+        #cure the cases which are due, entries of infections undone by a rejected step are skipped
+        while self.recovery and self.t - self.duration > self.recovery[0][0]:
+            t, i = heapq.heappop(self.recovery)
+            if self.state[i] == INFECTED and self.infection_time[i] == t:
+                self.state[i] = RECOVERED
+                self.n_recovered += 1
+        #save amount of cases and of recovered cases
+        self.cases.append(self.n_cases)
+        self.recovered.append(self.n_recovered)
+
+        if self.n_recovered == self.n:
             self.end = True
 
     def update_distance(self):
@@ -84,6 +302,12 @@ class Simulation:
     def update_force(self):
         self.f = np.zeros((self.dim, self.n))
 
+        #the infection rate is a probability per step of size dt0, for other step sizes it is rescaled,
+        #so that the probability of an infection per contact time does not depend on the step size
+        rate = self.rate
+        if self.step_dt != self.dt0:
+            rate = 1 - (1 - self.rate)**(self.step_dt / self.dt0)
+
         for pair in self.verlet:
             r_vec = self.x[:,pair[1]]-self.x[:,pair[0]]
             r = np.linalg.norm(r_vec)
@@ -92,10 +316,11 @@ class Simulation:
             self.f[:,pair[1]] += f_ij
 
             if r < 1:
-                if (self.infected[pair[0]] >= 0) & (self.infected[pair[1]]==-1) & (np.random.random() < self.rate):
-                    self.infected[pair[1]] = self.t
-                if (self.infected[pair[1]] >= 0) & (self.infected[pair[0]]==-1) & (np.random.random() < self.rate):
-                    self.infected[pair[0]] = self.t
+                #both random numbers are drawn for every contact, so the random stream doesn't depend on the states
+                if (self.state[pair[0]] == INFECTED) & (self.state[pair[1]] == SUSCEPTIBLE) & (np.random.random() < rate):
+                    self.infect(pair[1])
+                if (self.state[pair[1]] == INFECTED) & (self.state[pair[0]] == SUSCEPTIBLE) & (np.random.random() < rate):
+                    self.infect(pair[0])
 
         self.force_cutoff()
 
@@ -118,102 +343,372 @@ class Simulation:
                     self.f = np.multiply(self.f, np.where(F>self.fmax, self.fmax*np.power(F,-1), 1))
 
     def reset(self):
-        self.infected = -np.ones(self.n)
+        self.state = np.full(self.n, SUSCEPTIBLE, dtype=np.int8)
+        self.infection_time = np.zeros(self.n)
+        self.recovery = []
+        self.n_cases = 0
+        self.n_recovered = 0
         self.t = 0
         p0 = int(np.random.uniform(0, self.n-0.5))
-        self.infected[p0] = self.t
+        self.infect(p0)
         self.fixed[:,p0] = 1
         self.cases = []
         self.recovered = []
 
 
-#number of particles
-N = 300
-
-#box size
-BOX = np.array([100, 100])
-
-#simulation time
-T_MAX = 50
-
-#integration time-step
-DT = 0.001
-
-#parameter for the average particle movement
-T = 3
-
-#maximum force during warm up
-f_max = 200
-
-#duration time of the disease
-duration = 8
-
-#infection probability during contact
-infection_rate = 0.1
-
-#percentage of particles, which dont move
-fix_rate = 0.15
-
-DIM = BOX.shape[0]
-
-#random initialization of the particle positions
-x = np.random.random((DIM,N)) - 0.5
-for i in range(0, DIM):
-    x[i,:] = x[i,:]*BOX[i]
-
-#initialization of the particle velocities
-v = np.random.normal(0, T, size=(DIM, N))
+def place_particles(n, box, r_min=1., max_attempts=100, rsa_max=0.45):
+    #random sequential placement of n particles in the box without any pair closer than r_min,
+    #a background grid with cell size r_min/sqrt(dim) holds at most one particle per cell,
+    #so every overlap check only looks at the neighbouring cells. random placement jams at a packing
+    #fraction of about 0.55, so denser systems and runs out of attempts use a jittered lattice
+    dim = box.shape[0]
+    packing = n * np.pi**(dim/2) / math.gamma(dim/2 + 1) * (0.5 * r_min)**dim / np.prod(box)
+    if packing > rsa_max:
+        return place_lattice(n, box, r_min)
+
+    cell = r_min / np.sqrt(dim)
+    reach = int(np.ceil(np.sqrt(dim)))
+    low = -0.5 * box + 0.5 * r_min
+    high = 0.5 * box - 0.5 * r_min
+    shape = np.maximum(np.ceil((high - low) / cell).astype(int), 1)
+    grid = -np.ones(shape, dtype=np.int64)
+    x = np.zeros((dim, n))
+
+    placed = 0
+    attempts = 0
+    while placed < n:
+        if attempts > max_attempts * n:
+            return place_lattice(n, box, r_min)
+
+        #propose candidates in batches to keep the rng calls vectorized
+        candidates = low + (high - low) * np.random.random((n - placed, dim))
+        for pos in candidates:
+            idx = np.minimum(((pos - low) / cell).astype(int), shape - 1)
+            window = tuple(slice(max(k - reach, 0), k + reach + 1) for k in idx)
+            neighbours = grid[window]
+            neighbours = neighbours[neighbours >= 0]
+            if np.all(np.sum((x[:, neighbours].transpose() - pos)**2, axis=1) >= r_min**2):
+                x[:, placed] = pos
+                grid[tuple(idx)] = placed
+                placed += 1
+        attempts += candidates.shape[0]
+    return x
+
+def place_lattice(n, box, r_min=1.):
+    #n particles on randomly chosen sites of the widest hexagonal (2d) or cubic lattice with at least n sites
+    #in the box, every particle is moved by a random offset which keeps all pairs at least r_min apart
+    dim = box.shape[0]
+    low = -0.5 * box + 0.5 * r_min
+    size = box - r_min
+
+    def lattice(a):
+        if dim == 2:
+            rows = np.arange(int(size[1] / (a * np.sqrt(3)/2)) + 1) * a * np.sqrt(3)/2
+            columns = np.arange(int(max(size[0] - a/2, 0) / a) + 1) * a
+            x, y = np.meshgrid(columns, rows)
+            x = x + 0.5 * a * (np.arange(len(rows)) % 2)[:, None]
+            return np.array([x.ravel(), y.ravel()])
+        axes = [np.arange(int(length / a) + 1) * a for length in size]
+        return np.array([g.ravel() for g in np.meshgrid(*axes)])
+
+    #largest spacing with enough sites by bisection
+    a_low, a_high = 0., max(np.max(size), r_min) + 1.
+    for i in range(60):
+        a = 0.5 * (a_low + a_high)
+        if lattice(a).shape[1] >= n:
+            a_low = a
+        else:
+            a_high = a
+    sites = lattice(a_low)
+    if a_low < r_min:
+        print('density too high for an overlap-free placement, lattice spacing: '+str(a_low))
+
+    x = sites[:, np.random.choice(sites.shape[1], n, replace=False)]
+    jitter = max(a_low - r_min, 0) / (2 * np.sqrt(dim))
+    x = x + np.random.uniform(-jitter, jitter, x.shape)
+    return np.clip(x + low[:, None], low[:, None], (low + size)[:, None])
+
+class Profiler:
+    def __init__(self, interval=1000):
+        #cumulative time and number of calls per phase, a trace row is recorded every interval steps
+        self.interval = interval
+        self.time = {}
+        self.calls = {}
+        self.steps = 0
+        self.pairs = 0
+        self.max_pairs = 0
+        self.start = time.perf_counter()
+        self.last = (self.start, 0, {}, 0)
+        self.trace = []
+
+    def wrap(self, phase, function):
+        self.time[phase] = 0.
+        self.calls[phase] = 0
+
+        def timed(*args, **kwargs):
+            t0 = time.perf_counter()
+            result = function(*args, **kwargs)
+            self.time[phase] += time.perf_counter() - t0
+            self.calls[phase] += 1
+            return result
+        return timed
+
+    def step(self, sim):
+        pairs = len(sim.verlet)
+        self.steps += 1
+        self.pairs += pairs
+        self.max_pairs = max(self.max_pairs, pairs)
+
+        if self.steps % self.interval == 0:
+            now = time.perf_counter()
+            t_last, steps_last, time_last, rebuilds_last = self.last
+            rebuilds = self.calls.get('update_verlet', 0)
+            row = dict(step=self.steps, t=sim.t, wall=now - self.start,
+                       steps_per_s=(self.steps - steps_last) / (now - t_last),
+                       rebuilds=rebuilds - rebuilds_last, pairs=pairs)
+            for phase in self.time:
+                row[phase] = self.time[phase] - time_last.get(phase, 0.)
+            self.trace.append(row)
+            self.last = (now, self.steps, dict(self.time), rebuilds)
+
+    def summary(self):
+        #table of the cumulative time per phase and the counters of the whole run
+        wall = time.perf_counter() - self.start
+        lines = ['%-16s %10s %12s %14s %8s' % ('phase', 'calls', 'time [s]', 'per call [us]', 'share')]
+        for phase in self.time:
+            calls = self.calls[phase]
+            lines.append('%-16s %10d %12.3f %14.1f %7.1f%%' % (phase, calls, self.time[phase],
+                         1e6 * self.time[phase] / max(calls, 1), 100 * self.time[phase] / wall))
+        lines.append('steps: %d, steps per second: %.1f, wall time: %.3f s' % (self.steps, self.steps / wall, wall))
+        lines.append('verlet rebuilds: %d, mean pairs: %.1f, max pairs: %d'
+                     % (self.calls.get('update_verlet', 0), self.pairs / max(self.steps, 1), self.max_pairs))
+        return '\n'.join(lines)
+
+    def save_trace(self, filename):
+        #write the per-interval trace as a csv file
+        if not self.trace:
+            return
+        keys = list(self.trace[0].keys())
+        np.savetxt(filename, [[row.get(key, 0.) for key in keys] for row in self.trace],
+                   delimiter=',', header=','.join(keys), comments='', fmt='%.6g')
+
+
+def snapshots(sim, frame_time, size=1024):
+    #advance the simulation and yield a lightweight snapshot of positions, states and the case curves every
+    #frame_time, the curves (time, cases, recovered) keep every stride-th frame and at most size points,
+    #when they are full every second point is dropped and the stride doubles, the current frame is always the last point
+    curve = np.empty((size, 3))
+    n = 0
+    stride = 1
+    frame = 0
+    while sim.t < sim.T_MAX:
+        t_frame = sim.t + frame_time
+        while sim.t < t_frame - 0.5 * sim.dt:
+            sim.vv_step()
+        point = (sim.t, sim.cases[-1], sim.recovered[-1])
+        if frame % stride == 0:
+            if n == size:
+                curve[:size//2] = curve[0:size:2]
+                n = size // 2
+                stride *= 2
+            if frame % stride == 0:
+                curve[n] = point
+                n += 1
+        frame += 1
+        yield sim.x.astype(np.float32), sim.state.copy(), np.vstack([curve[:n], point]).T
+
+
+class FrameRenderer:
+    def __init__(self, box, n, t_max, dpi):
+        #every worker process draws on its own off-screen figure, which is reused for all of its frames
+        self.fig = Figure(figsize=(12.8, 4.8), dpi=dpi)
+        self.canvas = FigureCanvasAgg(self.fig)
+        plot, axis = self.fig.subplots(1, 2)
+
+        self.points = plot.scatter([], [], s=8)
+        plot.set_xlim(-0.5*(1+box[0]), (1+box[0])*0.5)
+        plot.set_ylim(-0.5*(1+box[1]), (1+box[1])*0.5)
+
+        self.cases, = axis.plot([], 'k', label='overall cases')
+        self.cur, = axis.plot([], 'r', label='current cases')
+        self.rec, = axis.plot([], 'g', label='recovered cases')
+        axis.set_ylim(ymin=0, ymax=n)
+        axis.set_xlim(xmin=0, xmax=t_max)
+        axis.legend(loc='upper left')
+
+        self.colours = np.array(['b', 'r', 'g'])
+
+    def render(self, snapshot):
+        x, state, (times, cases, recovered) = snapshot
+        self.points.set_offsets(x.transpose())
+        self.points.set_color(self.colours[state])
+        self.cases.set_data(times, cases)
+        self.cur.set_data(times, cases - recovered)
+        self.rec.set_data(times, recovered)
+        self.canvas.draw()
+        return np.asarray(self.canvas.buffer_rgba())[:, :, :3].copy()
+
+
+def init_renderer(box, n, t_max, dpi):
+    global renderer
+    renderer = FrameRenderer(box, n, t_max, dpi)
+
+
+def render_frame(snapshot):
+    return renderer.render(snapshot)
+
+
+class FrameEncoder:
+    def __init__(self, filename, fps):
+        #frames are piped into ffmpeg one by one, if it is not installed gif files are written frame by frame
+        #with pillow, every frame with its own palette, other formats need ffmpeg
+        self.filename = filename
+        self.fps = fps
+        self.ffmpeg = shutil.which('ffmpeg')
+        self.process = None
+        self.file = None
+        if self.ffmpeg is None and not filename.lower().endswith('.gif'):
+            raise RuntimeError('ffmpeg is needed to write '+filename+', without it only gif files can be written')
+
+    def write(self, frame):
+        if self.ffmpeg is None:
+            image = Image.fromarray(frame).quantize()
+            if self.file is None:
+                self.file = open(self.filename, 'wb')
+                header, palette = GifImagePlugin.getheader(image, info={'loop': 0})
+                self.file.write(b''.join(header))
+            self.file.write(b''.join(GifImagePlugin.getdata(image, duration=1000/self.fps, include_color_table=True)))
+            return
+
+        if self.process is None:
+            height, width = frame.shape[:2]
+            self.process = subprocess.Popen([self.ffmpeg, '-y', '-loglevel', 'error', '-f', 'rawvideo',
+                                             '-pix_fmt', 'rgb24', '-s', '%dx%d' % (width, height),
+                                             '-r', str(self.fps), '-i', '-', self.filename],
+                                            stdin=subprocess.PIPE)
+        self.process.stdin.write(frame.tobytes())
+
+    def close(self):
+        if self.process is not None:
+            self.process.stdin.close()
+            self.process.wait()
+        elif self.file is not None:
+            #gif trailer
+            self.file.write(b';')
+            self.file.close()
+            self.file = None
+
+
+def export_animation(sim, filename, frame_time, fps=30, dpi=100, workers=None):
+    #the simulation produces snapshots, a pool of processes rasterizes them in parallel
+    #and the encoder streams the frames to the output file in order. at most 2 frames per worker are in flight,
+    #the oldest one is written before the next snapshot is submitted, so memory does not grow with the frame count
+    workers = workers or os.cpu_count()
+    encoder = FrameEncoder(filename, fps)
+    if sim.profiler is not None:
+        encoder.write = sim.profiler.wrap('encode', encoder.write)
+    with multiprocessing.Pool(workers, initializer=init_renderer, initargs=(sim.box, sim.n, sim.T_MAX, dpi)) as pool:
+        pending = collections.deque()
+        for snapshot in snapshots(sim, frame_time):
+            if len(pending) == 2 * workers:
+                encoder.write(pending.popleft().get())
+            pending.append(pool.apply_async(render_frame, (snapshot,)))
+        while pending:
+            encoder.write(pending.popleft().get())
+    encoder.close()
+
+
+if __name__ == '__main__':
+    #number of particles
+    N = 300
+
+    #box size
+    BOX = np.array([100, 100])
+
+    #simulation time
+    T_MAX = 50
+
+    #integration time-step
+    DT = 0.001
+
+    #parameter for the average particle movement
+    T = 3
+
+    #place the particles without overlap instead of running a capped-force warm up
+    overlap_free = True
+
+    #maximum force during warm up
+    f_max = 200
+
+    #duration time of the disease
+    duration = 8
+
+    #infection probability during contact
+    infection_rate = 0.1
+
+    #percentage of particles, which dont move
+    fix_rate = 0.15
+
+    #use adaptive time steps with DT as the initial step size
+    adaptive = False
+
+    #simulation time between two animation frames
+    frame_time = 0.05
+
+    #number of processes rendering frames, output file and frame rate of the animation
+    workers = os.cpu_count()
+    output = 'animation.gif'
+    fps = 30
+    dpi = 100
+
+    #record the time spent per phase and write the trace to profile.csv
+    profile = False
+
+    #checkpoint file and number of integration steps between two checkpoints
+    checkpoint_file = 'checkpoint.npz'
+    checkpoint_interval = 10000
+
+    DIM = BOX.shape[0]
+
+    if overlap_free:
+        #no pair is within the force range, so no warm up is needed
+        x = place_particles(N, BOX)
+        f_max = float('nan')
+    else:
+        #random initialization of the particle positions
+        x = np.random.random((DIM,N)) - 0.5
+        for i in range(0, DIM):
+            x[i,:] = x[i,:]*BOX[i]
+
+    #initialization of the particle velocities
+    v = np.random.normal(0, T, size=(DIM, N))
+
+    #set the simulation up
+    sim = Simulation(T_MAX, DT, x, v, BOX, duration, infection_rate, 0.5,  fix_rate, fmax=f_max,
+                     checkpoint_file=checkpoint_file, checkpoint_interval=checkpoint_interval, adaptive=adaptive)
+
+    #resume a preempted run from its last checkpoint, a checkpoint of other parameters is moved aside
+    if os.path.exists(checkpoint_file):
+        mismatch = sim.checkpoint_mismatch(checkpoint_file)
+        if mismatch:
+            os.replace(checkpoint_file, checkpoint_file + '.stale')
+            print('checkpoint has different parameters ('+', '.join(mismatch)+'), moved to '+checkpoint_file+'.stale')
+        else:
+            sim.load_checkpoint(checkpoint_file)
+            print('resumed from checkpoint at time: '+str(sim.t))
 
-#set the simulation up
-sim = Simulation(T_MAX, DT, x, v, BOX, duration, infection_rate, 0.5,  fix_rate, fmax=f_max)
+    if profile:
+        sim.enable_profiling()
 
-#set the plot framework
-fig = plt.figure()
-col = np.where(sim.infected >= 0,'r', np.where(sim.infected == -2,'g','b'))
-points = plt.scatter(x[0,:], x[1,:], s=8, c=col)
-plot = fig.axes[0]
-plot.set_xlim(-0.5*(1+sim.box[0]), (1+sim.box[0])*0.5)
-plot.set_ylim(-0.5*(1+sim.box[1]), (1+sim.box[1])*0.5)
+    start = time.time()
+    export_animation(sim, output, frame_time, fps=fps, dpi=dpi, workers=workers)
+    end = time.time()
+    print('computation time: '+str(end-start))
 
-fig2 = plt.figure()
-cases, = plt.plot([], 'k', label='overall cases')
-cur, = plt.plot([], 'r', label='current cases')
-rec, = plt.plot([], 'g', label='recovered cases')
-axis = fig2.axes[0]
-axis.set_ylim(ymin=0, ymax=N)
-axis.set_xlim(xmin=0, xmax=T_MAX)
-plt.legend(loc='upper left')
+    #the run is complete, so the next launch starts a new one
+    if os.path.exists(checkpoint_file):
+        os.remove(checkpoint_file)
 
-#when does the animation stop
-def frames():
-    while sim.t < sim.T_MAX:
-        yield 1
-
-#set new positions and colours
-def animate(j):
-    for i in range(0, int(0.05/DT)):
-        sim.vv_step()
-
-    #if sim.t >= sim.T_MAX:
-    #    sim.T_MAX = sim.T_MAX * 2.
-    #    axis.set_xlim(xmin=0, xmax=sim.T_MAX)
-
-    xdata = np.linspace(0,sim.t,len(sim.recovered))
-    rec.set_xdata(xdata)
-    rec.set_ydata(sim.recovered)
-    cur.set_xdata(xdata)
-    cur.set_ydata(np.array(sim.cases)-np.array(sim.recovered))
-    cases.set_xdata(xdata)
-    cases.set_ydata(sim.cases)
-    points.set_offsets(sim.x.transpose())
-    points.set_color(np.where(sim.infected >= 0, 'r', np.where(sim.infected == -2,'g','b')))
-    return points, cases, cur, rec
-
-
-ani = animation.FuncAnimation(fig2, animate, frames=frames, interval=1, blit=True)
-#plt.show()
-
-start = time.time()
-ani.save('animation.gif', writer='Pillow', fps=30, dpi=100)
-end = time.time()
-print('computation time: '+str(end-start))
+    if profile:
+        print(sim.profiler.summary())
+        sim.profiler.save_trace('profile.csv')
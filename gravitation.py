@@ -5,10 +5,13 @@ Created on Sat Apr 18 20:43:33 2020
 @author: Leon Kloker
 """
 import numpy as np
+import time
+import multiprocessing
 import matplotlib.pyplot as plt
 import matplotlib.animation as animation
 import mpl_toolkits.mplot3d.axes3d as p3
 from mpl_toolkits.mplot3d.art3d import juggle_axes
+from diagnostics import EnergyMonitor
 
 class mass:
     def __init__(self, dt, T, gamma, m, r0, phi0, theta0, r1 , phi1, theta1):
@@ -24,7 +27,13 @@ class mass:
         self.r = r0
         self.r_v = r1
         self.E = self.energy()
-        
+
+        #optional perturbing acceleration f(q, v, t) -> (3,...) for the wisdom-holman splitting
+        self.perturbation = None
+        #cartesian state of the cartesian integrators and the spherical state it belongs to
+        self.cartesian = None
+        self.spherical = None
+
     def euler_ex(self):
         r_a, phi_a, theta_a = self.eq_motion(self.r, self.phi, self.theta, self.r_v, self.phi_v, self.theta_v)
         
@@ -74,7 +83,377 @@ class mass:
         y = self.r * np.sin(self.theta) * np.sin(self.phi)
         z = self.r * np.cos(self.theta)       
         return x,y,z
-    
+
+    def energy_drift(self):
+        #relative change of the energy since the start
+        return (self.energy() - self.E) / np.abs(self.E)
+
+    def cartesian_state(self):
+        #position and velocity in cartesian coordinates, the integrators below keep this state between their steps,
+        #so they don't suffer from the singularity of the spherical equations of motion at the poles
+        state = (self.r, self.phi, self.theta, self.r_v, self.phi_v, self.theta_v)
+        if self.cartesian is not None and all(np.array_equal(a, b) for a, b in zip(state, self.spherical)):
+            return self.cartesian
+
+        st, ct = np.sin(self.theta), np.cos(self.theta)
+        sp, cp = np.sin(self.phi), np.cos(self.phi)
+        e_r = np.array([st*cp, st*sp, ct])
+        e_theta = np.array([ct*cp, ct*sp, -st])
+        e_phi = np.array([-sp, cp, 0*sp])
+        q = self.r * e_r
+        v = self.r_v * e_r + self.r * self.theta_v * e_theta + self.r * st * self.phi_v * e_phi
+        return q, v
+
+    def set_cartesian_state(self, q, v):
+        rho2 = q[0]**2 + q[1]**2
+        rho = np.sqrt(rho2)
+        r = np.sqrt(rho2 + q[2]**2)
+        #continue phi from its previous value instead of wrapping it to (-pi, pi]
+        phi = np.arctan2(q[1], q[0])
+        phi = self.phi + (phi - self.phi + np.pi) % (2*np.pi) - np.pi
+        with np.errstate(divide='ignore', invalid='ignore'):
+            rho_v = np.where(rho > 0, (q[0]*v[0] + q[1]*v[1]) / rho, 0)
+            phi_v = np.where(rho > 0, (q[0]*v[1] - q[1]*v[0]) / rho2, 0)
+
+        self.r = r
+        self.phi = phi
+        self.theta = np.arctan2(rho, q[2])
+        self.r_v = (q[0]*v[0] + q[1]*v[1] + q[2]*v[2]) / r
+        self.phi_v = phi_v
+        self.theta_v = (q[2]*rho_v - rho*v[2]) / r**2
+        self.cartesian = (q, v)
+        self.spherical = tuple(np.copy(a) for a in (self.r, self.phi, self.theta, self.r_v, self.phi_v, self.theta_v))
+
+    def cartesian_acceleration(self, q):
+        return -self.gamma * q / np.sqrt(q[0]**2 + q[1]**2 + q[2]**2)**3
+
+    def leapfrog(self, dt=None, state=None):
+        #second order drift-kick-drift step in cartesian coordinates, the base of the yoshida compositions
+        dt = self.dt if dt is None else dt
+        q, v = self.cartesian_state() if state is None else state
+        q = q + 0.5 * dt * v
+        v = v + dt * self.cartesian_acceleration(q)
+        q = q + 0.5 * dt * v
+        if state is not None:
+            return q, v
+        self.set_cartesian_state(q, v)
+        self.t += dt
+
+    def composition(self, weights):
+        #symmetric composition of leapfrog steps with the given weights
+        state = self.cartesian_state()
+        for w in weights:
+            state = self.leapfrog(w * self.dt, state)
+        self.set_cartesian_state(*state)
+        self.t += self.dt
+
+    def yoshida4(self):
+        w1 = 1 / (2 - 2**(1/3))
+        w0 = -2**(1/3) * w1
+        self.composition([w1, w0, w1])
+
+    def yoshida6(self):
+        #yoshida's solution A
+        w1, w2, w3 = -1.17767998417887, 0.235573213359357, 0.784513610477560
+        w0 = 1 - 2 * (w1 + w2 + w3)
+        self.composition([w3, w2, w1, w0, w1, w2, w3])
+
+    def kepler_drift(self, q, v, dt):
+        #exact propagation on the kepler orbit with universal variables (f and g functions)
+        mu = self.gamma
+        r0 = np.sqrt(q[0]**2 + q[1]**2 + q[2]**2)
+        v2 = v[0]**2 + v[1]**2 + v[2]**2
+        alpha = 2 / r0 - v2 / mu
+        sigma = (q[0]*v[0] + q[1]*v[1] + q[2]*v[2]) / np.sqrt(mu)
+
+        x = np.sqrt(mu) * np.abs(alpha) * dt + 0*r0
+        for i in range(50):
+            z = alpha * x**2
+            c, s = stumpff(z)
+            r = sigma * x * (1 - z*s) + (1 - alpha*r0) * x**2 * c + r0
+            f = sigma * x**2 * c + (1 - alpha*r0) * x**3 * s + r0 * x - np.sqrt(mu) * dt
+            step = f / r
+            x = x - step
+            if np.all(np.abs(step) <= 1e-15 * np.maximum(np.abs(x), 1e-300)):
+                break
+
+        z = alpha * x**2
+        c, s = stumpff(z)
+        r = sigma * x * (1 - z*s) + (1 - alpha*r0) * x**2 * c + r0
+        f = 1 - x**2 * c / r0
+        g = dt - x**3 * s / np.sqrt(mu)
+        f_v = np.sqrt(mu) / (r * r0) * x * (z*s - 1)
+        g_v = 1 - x**2 * c / r
+        return f*q + g*v, f_v*q + g_v*v
+
+    def wisdom_holman(self):
+        #kick-drift-kick splitting into the exactly solved kepler motion and the perturbation
+        q, v = self.cartesian_state()
+        if self.perturbation is not None:
+            v = v + 0.5 * self.dt * self.perturbation(q, v, self.t)
+        q, v = self.kepler_drift(q, v, self.dt)
+        if self.perturbation is not None:
+            v = v + 0.5 * self.dt * self.perturbation(q, v, self.t + self.dt)
+        self.set_cartesian_state(q, v)
+        self.t += self.dt
+
+def stumpff(z):
+    #stumpff functions c(z) and s(z), with series expansions close to zero
+    z = np.asarray(z, dtype=float)
+    small = np.abs(z) < 1e-6
+    zp = np.where(z > 0, z, 1)
+    zn = np.where(z < 0, -z, 1)
+    sq_p, sq_n = np.sqrt(zp), np.sqrt(zn)
+    c = np.where(small, 1/2 - z/24 + z**2/720,
+                 np.where(z > 0, (1 - np.cos(sq_p)) / zp, (np.cosh(sq_n) - 1) / zn))
+    s = np.where(small, 1/6 - z/120 + z**2/5040,
+                 np.where(z > 0, (sq_p - np.sin(sq_p)) / sq_p**3, (np.sinh(sq_n) - sq_n) / sq_n**3))
+    return c, s
+
+def integrator_report(dt, steps, gamma, m, r0, phi0, theta0, r1, phi1, theta1,
+                      methods=('euler_ex', 'velocity_verlet', 'leapfrog', 'yoshida4', 'yoshida6', 'wisdom_holman')):
+    #energy drift and run time of every integration method for the same initial condition
+    lines = ['%-16s %16s %16s %12s' % ('method', 'final drift', 'max drift', 'time [s]')]
+    for method in methods:
+        sat = mass(dt, steps*dt, gamma, m, r0, phi0, theta0, r1, phi1, theta1)
+        drift = 0.
+        t0 = time.perf_counter()
+        for i in range(steps):
+            getattr(sat, method)()
+            drift = max(drift, np.max(np.abs(sat.energy_drift())))
+        lines.append('%-16s %16.3e %16.3e %12.4f' % (method, np.max(np.abs(sat.energy_drift())), drift,
+                                                     time.perf_counter() - t0))
+    return '\n'.join(lines)
+
+
+class ensemble(mass):
+    def __init__(self, dt, T, gamma, m, r0, phi0, theta0, r1, phi1, theta1):
+        #M test bodies around the same central mass, the coordinates and rates are arrays of length M,
+        #all methods of mass work elementwise on them, so each step advances the whole ensemble at once
+        state = np.broadcast_arrays(*[np.array(a, dtype=float) for a in (r0, phi0, theta0, r1, phi1, theta1)])
+        super().__init__(dt, T, gamma, m, *[a.copy() for a in state])
+
+    def state(self):
+        return np.array([self.r, self.phi, self.theta, self.r_v, self.phi_v, self.theta_v])
+
+    def set_state(self, state):
+        self.r, self.phi, self.theta, self.r_v, self.phi_v, self.theta_v = [a.copy() for a in state]
+
+    def propagate(self, steps, method='velocity_verlet', workers=1):
+        #advance the ensemble by steps, with several workers the members are split into chunks across processes
+        if workers == 1:
+            for i in range(steps):
+                getattr(self, method)()
+            return
+
+        chunks = np.array_split(np.arange(self.r.shape[0]), workers)
+        m = np.broadcast_to(self.m, self.r.shape)
+        state = self.state()
+        with multiprocessing.Pool(workers) as pool:
+            results = pool.map(propagate_chunk, [(self.dt, self.gamma, m[c], state[:, c], steps, method) for c in chunks])
+        self.set_state(np.concatenate(results, axis=1))
+        self.t += steps * self.dt
+
+def propagate_chunk(args):
+    dt, gamma, m, state, steps, method = args
+    chunk = ensemble(dt, 0, gamma, m, *state)
+    chunk.propagate(steps, method)
+    return chunk.state()
+
+class bodies:
+    def __init__(self, dt, T, G, m, x, v, eps=0., chunk=1024, theta=None):
+        #n bodies with masses m (n,) under mutual gravity in cartesian coordinates, x and v have shape (3,n),
+        #eps softens close encounters and the pair interactions are evaluated in blocks of chunk bodies,
+        #with an opening angle theta the forces come from a Barnes-Hut tree instead of all pairs
+        self.G = G
+        self.theta = theta
+        self.m = np.array(m, dtype=float)
+        self.dt = dt
+        self.t = 0
+        self.T = T
+        self.eps = eps
+        self.chunk = chunk
+        self.x = np.array(x, dtype=float)
+        self.v = np.array(v, dtype=float)
+        self.n = self.m.shape[0]
+        self.a = self.acceleration(self.x)
+        self.E = self.energy()
+
+    def euler_ex(self):
+        a = self.acceleration(self.x)
+        self.x += self.v * self.dt
+        self.v += self.dt * a
+        self.t += self.dt
+
+    def velocity_verlet(self):
+        #the acceleration at the end of a step is kept for the next one, so every step needs one evaluation
+        self.x += self.v * self.dt + 0.5*self.dt**2 * self.a
+        a = self.acceleration(self.x)
+        self.v += 0.5 * self.dt * (self.a + a)
+        self.a = a
+        self.t += self.dt
+
+    def acceleration(self, x):
+        if self.theta is not None:
+            return self.tree_acceleration(x, self.theta)
+        return self.direct_acceleration(x)
+
+    def direct_acceleration(self, x):
+        a = np.zeros_like(x)
+        for start in range(0, self.n, self.chunk):
+            end = min(start + self.chunk, self.n)
+            r2 = np.full((end - start, self.n), self.eps**2)
+            for k in range(3):
+                r2 += (x[k, None, :] - x[k, start:end, None])**2
+            #no self interaction
+            r2[np.arange(end - start), np.arange(start, end)] = np.inf
+            w = self.m / (r2 * np.sqrt(r2))
+            #sum_j w_ij (x_j - x_i) as a matrix product, relative to the centre of the block to limit cancellation
+            xc = x - np.mean(x[:, start:end], axis=1, keepdims=True)
+            a[:, start:end] = self.G * (xc @ w.T - xc[:, start:end] * np.sum(w, axis=1))
+        return a
+
+    def build_tree(self, x, levels=20):
+        #flat Barnes-Hut tree, an octree or a quadtree if all bodies lie in a plane z = const.
+        #the bodies are sorted along a morton curve, so every node covers a contiguous range of sorted bodies
+        #and the children of a node are contiguous in the next level, only nodes with more than one body are split
+        dim = 3 if np.ptp(x[2]) > 0 else 2
+        lo = np.min(x[:dim], axis=1)
+        size = max(np.max(np.ptp(x[:dim], axis=1)), 1e-300) * (1 + 1e-12)
+        q = np.minimum(((x[:dim] - lo[:, None]) / size * 2**levels).astype(np.int64), 2**levels - 1)
+        code = np.zeros(self.n, dtype=np.int64)
+        for bit in range(levels):
+            for k in range(dim):
+                code |= ((q[k] >> bit) & 1) << (dim * bit + k)
+        order = np.argsort(code, kind='stable')
+        code = code[order]
+
+        #prefix sums of mass and mass weighted positions give the moments of every body range
+        m = self.m[order]
+        cum_m = np.concatenate(([0.], np.cumsum(m)))
+        cum_mx = np.concatenate((np.zeros((3, 1)), np.cumsum(m * x[:, order], axis=1)), axis=1)
+
+        starts, counts, level = [], [], []
+        parent_count = None
+        for l in range(levels + 1):
+            key = code >> (dim * (levels - l))
+            start = np.concatenate(([0], np.flatnonzero(np.diff(key)) + 1))
+            count = np.diff(np.append(start, self.n))
+            if parent_count is not None:
+                #keep the nodes whose parent was split
+                parent = np.searchsorted(parent_start, start, side='right') - 1
+                keep = parent_count[parent] > 1
+                starts.append(start[keep])
+                counts.append(count[keep])
+                level.append(np.full(np.count_nonzero(keep), l))
+            else:
+                starts.append(start)
+                counts.append(count)
+                level.append(np.zeros(1, dtype=np.int64))
+            parent_start, parent_count = start, count
+            if np.all(count[keep] <= 1 if l > 0 else count <= 1):
+                break
+
+        offsets = np.cumsum([0] + [len(st) for st in starts])
+        start = np.concatenate(starts)
+        count = np.concatenate(counts)
+        level = np.concatenate(level)
+        end = start + count
+        mass = cum_m[end] - cum_m[start]
+        with np.errstate(invalid='ignore', divide='ignore'):
+            com = np.where(mass > 0, (cum_mx[:, end] - cum_mx[:, start]) / mass, x[:, order[start]])
+
+        #children of a split node are the nodes of the next level starting inside its range
+        child_first = np.zeros(len(start), dtype=np.int64)
+        child_count = np.zeros(len(start), dtype=np.int64)
+        for l in range(len(starts) - 1):
+            node = slice(offsets[l], offsets[l + 1])
+            first = np.searchsorted(starts[l + 1], start[node])
+            last = np.searchsorted(starts[l + 1], end[node])
+            split = count[node] > 1
+            child_first[node] = np.where(split, offsets[l + 1] + first, 0)
+            child_count[node] = np.where(split, last - first, 0)
+
+        return dict(order=order, start=start, count=count, mass=mass, com=com, size=size / 2.**level,
+                    child_first=child_first, child_count=child_count)
+
+    def tree_acceleration(self, x, theta, tree=None):
+        #vectorized traversal: all (body, node) interactions of a block of bodies are processed level by level,
+        #a node is accepted if it is a leaf or its size is below theta times its distance, otherwise its children
+        #replace it, leaves with several bodies (coincident up to the tree depth) are summed directly
+        if tree is None:
+            tree = self.build_tree(x)
+        a = np.zeros_like(x)
+        for start in range(0, self.n, self.chunk):
+            body = np.arange(start, min(start + self.chunk, self.n))
+            node = np.zeros(len(body), dtype=np.int64)
+            while len(body) > 0:
+                d = tree['com'][:, node] - x[:, body]
+                r2 = np.sum(d**2, axis=0) + self.eps**2
+                leaf = tree['child_count'][node] == 0
+                accept = leaf | (tree['size'][node]**2 < theta**2 * r2)
+
+                #single body nodes and accepted cells, without the body itself
+                far = accept & ((tree['count'][node] == 1) | ~leaf)
+                far &= ~((tree['count'][node] == 1) & (tree['order'][tree['start'][node]] == body))
+                far &= r2 > 0
+                w = self.G * tree['mass'][node[far]] / (r2[far] * np.sqrt(r2[far]))
+                for k in range(3):
+                    a[k] += np.bincount(body[far], weights=w * d[k, far], minlength=self.n)
+
+                #leaves holding several bodies
+                group = accept & leaf & (tree['count'][node] > 1)
+                if np.any(group):
+                    counts = tree['count'][node[group]]
+                    b = np.repeat(body[group], counts)
+                    offsets = np.arange(len(b)) - np.repeat(np.cumsum(counts) - counts, counts)
+                    j = tree['order'][np.repeat(tree['start'][node[group]], counts) + offsets]
+                    dj = x[:, j] - x[:, b]
+                    rj2 = np.sum(dj**2, axis=0) + self.eps**2
+                    valid = (j != b) & (rj2 > 0)
+                    w = self.G * self.m[j[valid]] / (rj2[valid] * np.sqrt(rj2[valid]))
+                    for k in range(3):
+                        a[k] += np.bincount(b[valid], weights=w * dj[k, valid], minlength=self.n)
+
+                #open the remaining nodes
+                counts = tree['child_count'][node[~accept]]
+                body = np.repeat(body[~accept], counts)
+                offsets = np.arange(len(body)) - np.repeat(np.cumsum(counts) - counts, counts)
+                node = np.repeat(tree['child_first'][node[~accept]], counts) + offsets
+        return a
+
+    def accuracy_report(self, thetas=(0.3, 0.5, 0.7, 1.0)):
+        #compare the tree forces for several opening angles with direct summation at the current positions
+        t0 = time.perf_counter()
+        a_direct = self.direct_acceleration(self.x)
+        t_direct = time.perf_counter() - t0
+        norm = np.maximum(np.linalg.norm(a_direct, axis=0), 1e-300)
+
+        lines = ['%-8s %14s %14s %12s' % ('theta', 'rms rel error', 'max rel error', 'time [s]'),
+                 '%-8s %14.3e %14.3e %12.4f' % ('direct', 0., 0., t_direct)]
+        for theta in thetas:
+            t0 = time.perf_counter()
+            a = self.tree_acceleration(self.x, theta)
+            t_tree = time.perf_counter() - t0
+            error = np.linalg.norm(a - a_direct, axis=0) / norm
+            lines.append('%-8.2f %14.3e %14.3e %12.4f' % (theta, np.sqrt(np.mean(error**2)), np.max(error), t_tree))
+        return '\n'.join(lines)
+
+    def energy(self):
+        kinetic = 0.5 * np.sum(self.m * np.sum(self.v**2, axis=0))
+        potential = 0.
+        for start in range(0, self.n, self.chunk):
+            end = min(start + self.chunk, self.n)
+            d = self.x[:, None, :] - self.x[:, start:end, None]
+            r = np.sqrt(np.sum(d**2, axis=0) + self.eps**2)
+            #count every pair once
+            mask = np.arange(self.n)[None, :] > np.arange(start, end)[:, None]
+            potential -= self.G * np.sum(np.where(mask, self.m[start:end, None] * self.m[None, :] / np.where(mask, r, 1), 0))
+        return kinetic + potential
+
+    def cartesian_coordinates(self):
+        return self.x[0], self.x[1], self.x[2]
+
 if __name__ == '__main__':
     
     dt = 1
@@ -98,10 +477,10 @@ if __name__ == '__main__':
         x, y, z = sat.cartesian_coordinates()
         #masses.set_offsets([[0,0,0],[x,y,z]])
         masses.set_offsets([[0,0],[x,z]])
-        e = sat.energy()
-        energy.append(e)
-        line.set_xdata(np.linspace(0, sat.t, len(energy)))
-        line.set_ydata(energy)
+        energy.update(sat.t, sat.energy())
+        t, e = energy.history()
+        line.set_xdata(t)
+        line.set_ydata(e)
         
         if (x >= ax.get_xlim()).sum() > 0:
             ax.set_xlim(2*ax.get_xlim()[0],2*ax.get_xlim[1])
@@ -113,7 +492,7 @@ if __name__ == '__main__':
             sat.T *= 2
             axis.set_xlim(0, sat.T)
         
-        #axis.set_ylim(min(energy), max(energy))
+        #axis.set_ylim(*energy.limits())
         
         return masses, line
     
@@ -138,11 +517,19 @@ if __name__ == '__main__':
     axis = fig2.axes[0]
     axis.set_xlim(0, sat.T)
     axis.set_ylim(e-1000, e+1000)
-    energy = []
-    energy.append(e)
+    #running statistics and a decimated history of the energy, energy_file keeps every sample on disk
+    energy_file = None
+    energy = EnergyMonitor(size=512, filename=energy_file)
+    energy.update(sat.t, e)
     
+    #write the buffered energy samples when the animation window is closed
+    fig.canvas.mpl_connect('close_event', lambda event: energy.close())
+
     ani = animation.FuncAnimation(fig, animate, interval=10, blit=True)
-    plt.show()
+    try:
+        plt.show()
+    finally:
+        energy.close()
     
     
     
@@ -1,7 +1,9 @@
 import numpy as np
 import matplotlib.pyplot as plt
 from matplotlib import animation
-import random
+import heapq
+import multiprocessing
+from multiprocessing import shared_memory
 
 # ---------------- Simulation Parameters ---------------- #
 WIDTH = 10.0  # Width of the box
@@ -16,197 +18,721 @@ COOLDOWN_MEAN = 10.0  # Average cooldown time for red particles
 
 DT = 0.01  # Time step
 MAX_TIME = 50.0  # Maximum simulation time
+EVENT_DRIVEN = False  # Advance from collision to collision instead of using fixed time steps
+SEED = 0  # Seed of the random stream of the run
+
+HEADLESS = False  # Run as fast as possible without animation and write the results to disk
+STATS_FILE = 'proportions.npy'  # Time, green and red proportion every STATS_STRIDE steps
+STATS_STRIDE = 10
+SNAPSHOT_FILE = None  # Optional file for positions and colours every SNAPSHOT_STRIDE steps
+SNAPSHOT_STRIDE = 100
+WORKERS = 1  # Worker processes of the headless fixed-step run, each one owns a vertical strip of the box
+
+# ---------------- Random Numbers ---------------- #
+class RandomStream:
+    # All random numbers of a run come from one seeded numpy Generator. The per-collision infection draws
+    # and the cooldowns are drawn in blocks and handed out in order, so a run is reproducible from its seed.
+    def __init__(self, seed=None, block=65536):
+        self.generator = np.random.default_rng(seed)
+        self.block = block
+        self.uniforms = np.empty(0)
+        self.cooldowns = np.empty(0)
+
+    @staticmethod
+    def replicates(seed, n, block=65536):
+        # Independent streams for parallel replicates of a run
+        return [RandomStream(child, block) for child in np.random.SeedSequence(seed).spawn(n)]
+
+    def uniform(self, n):
+        if n > len(self.uniforms):
+            self.uniforms = np.concatenate((self.uniforms, self.generator.random(max(self.block, n))))
+        draws, self.uniforms = self.uniforms[:n], self.uniforms[n:]
+        return draws
+
+    def cooldown(self, n):
+        if n > len(self.cooldowns):
+            self.cooldowns = np.concatenate((self.cooldowns,
+                                             self.generator.exponential(COOLDOWN_MEAN, max(self.block, n))))
+        draws, self.cooldowns = self.cooldowns[:n], self.cooldowns[n:]
+        return draws
 
 # ---------------- Particle Initialization ---------------- #
-class Particle:
-    def __init__(self, position, velocity, is_red=False):
-        self.position = np.array(position, dtype=float)
-        self.velocity = np.array(velocity, dtype=float)
-        self.is_red = is_red
-        self.cooldown_timer = 0.0  # Time remaining in red state
+RSA_MAX_PACKING = 0.45  # Area fraction above which particles are placed on a jittered lattice
 
-def initialize_particles():
-    particles = []
-    # Initialize positions without overlapping
-    attempts = 0
-    max_attempts = 10000
-    while len(particles) < N_PARTICLES and attempts < max_attempts:
-        pos = np.array([random.uniform(0, WIDTH), random.uniform(0, HEIGHT)])
-        overlap = False
-        for p in particles:
-            # Compute minimum image distance considering periodic boundaries
-            delta = pos - p.position
-            delta[0] -= WIDTH * np.round(delta[0] / WIDTH)
-            delta[1] -= HEIGHT * np.round(delta[1] / HEIGHT)
-            if np.linalg.norm(delta) < 2 * PARTICLE_RADIUS:
-                overlap = True
+def place_random(n, rng):
+    # Random sequential placement accelerated by a periodic background grid. The cells are small enough
+    # to hold at most one particle, so a candidate only has to be checked against the grid entries around
+    # its cell. Candidates are proposed in batches, and the cells are split into phases whose cells are
+    # too far apart to conflict, so all candidates of one phase can be checked against the grid at once.
+    diameter = 2 * PARTICLE_RADIUS
+    nx = int(np.ceil(WIDTH / (diameter / np.sqrt(2))))
+    ny = int(np.ceil(HEIGHT / (diameter / np.sqrt(2))))
+    reach = int(np.ceil(diameter / min(WIDTH / nx, HEIGHT / ny)))
+    grid = -np.ones((nx, ny), dtype=np.int64)
+    positions = np.zeros((n, 2))
+    offsets = [(dx, dy) for dx in range(-reach, reach + 1) for dy in range(-reach, reach + 1)]
+
+    def phase(c, n_cells):
+        # Cells of the same phase are at least reach + 1 cells apart, also across the periodic boundary
+        period = reach + 1
+        regular = period * (n_cells // period)
+        return np.where(c < regular, c % period, period + c - regular)
+
+    n_placed = 0
+    while n_placed < n:
+        batch = max(n - n_placed, 1024)
+        candidates = rng.generator.random((batch, 2)) * (WIDTH, HEIGHT)
+        cx = np.minimum((candidates[:, 0] * nx / WIDTH).astype(np.int64), nx - 1)
+        cy = np.minimum((candidates[:, 1] * ny / HEIGHT).astype(np.int64), ny - 1)
+        phases = phase(cx, nx) * (2 * reach + 2) + phase(cy, ny)
+        accepted_batch = 0
+
+        for p in np.unique(phases):
+            # Keep the first candidate of every free cell in this phase
+            k = np.flatnonzero(phases == p)
+            k = k[grid[cx[k], cy[k]] < 0]
+            _, first = np.unique(cx[k] * ny + cy[k], return_index=True)
+            k = k[first]
+
+            free = np.ones(len(k), dtype=bool)
+            for dx, dy in offsets:
+                neighbour = grid[(cx[k] + dx) % nx, (cy[k] + dy) % ny]
+                occupied = neighbour >= 0
+                delta = minimum_image(candidates[k[occupied]] - positions[neighbour[occupied]])
+                free[np.flatnonzero(occupied)[np.sum(delta**2, axis=1) < diameter**2]] = False
+
+            k = k[free][:n - n_placed]
+            positions[n_placed:n_placed + len(k)] = candidates[k]
+            grid[cx[k], cy[k]] = np.arange(n_placed, n_placed + len(k))
+            n_placed += len(k)
+            accepted_batch += len(k)
+            if n_placed == n:
                 break
-        if not overlap:
-            # Initialize velocity from Maxwell-Boltzmann distribution
-            # Gaussian distribution for each velocity component
-            vx = np.random.normal(0, V_MEAN / np.sqrt(2))
-            vy = np.random.normal(0, V_MEAN / np.sqrt(2))
-            vel = np.array([vx, vy])
-            particles.append(Particle(pos, vel))
-        attempts += 1
-    if attempts == max_attempts:
+
+        if accepted_batch < 0.001 * batch:
+            return None
+    return positions
+
+def place_lattice(n, rng):
+    # Jittered square lattice with a spacing of at least one diameter, the particles occupy random sites
+    diameter = 2 * PARTICLE_RADIUS
+    nx = int(WIDTH // diameter)
+    ny = int(HEIGHT // diameter)
+    if n > nx * ny:
         raise Exception("Failed to initialize particles without overlap. Try reducing N_PARTICLES or PARTICLE_RADIUS.")
-    
+    spacing = np.array([WIDTH / nx, HEIGHT / ny])
+    sites = rng.generator.choice(nx * ny, size=n, replace=False)
+    cells = np.stack((sites // ny, sites % ny), axis=1)
+    jitter = (rng.generator.random((n, 2)) - 0.5) * (spacing - diameter)
+    return (cells + 0.5) * spacing + jitter
+
+# The particle state is held in contiguous arrays:
+# positions (N, 2), velocities (N, 2), is_red (N,) and cooldown (N,) with the time remaining in red state
+def initialize_particles(rng):
+    # Initialize positions without overlapping
+    packing = N_PARTICLES * np.pi * PARTICLE_RADIUS**2 / (WIDTH * HEIGHT)
+    positions = None
+    if packing <= RSA_MAX_PACKING:
+        positions = place_random(N_PARTICLES, rng)
+    if positions is None:
+        positions = place_lattice(N_PARTICLES, rng)
+
+    # Initialize velocity from Maxwell-Boltzmann distribution
+    # Gaussian distribution for each velocity component
+    velocities = rng.generator.normal(0, V_MEAN / np.sqrt(2), size=(N_PARTICLES, 2))
+
     # Assign initial red particles
+    is_red = np.zeros(N_PARTICLES, dtype=bool)
+    cooldown = np.zeros(N_PARTICLES)
     n_red = int(PROPORTION_RED * N_PARTICLES)
-    red_indices = random.sample(range(N_PARTICLES), n_red)
-    for idx in red_indices:
-        particles[idx].is_red = True
-        particles[idx].cooldown_timer = np.random.exponential(scale=COOLDOWN_MEAN)
-    return particles
+    red_indices = rng.generator.choice(N_PARTICLES, size=n_red, replace=False)
+    is_red[red_indices] = True
+    cooldown[red_indices] = rng.cooldown(n_red)
+    return positions, velocities, is_red, cooldown
 
-# ---------------- Collision Handling ---------------- #
-def handle_collision(p1, p2):
-    # Vector between centers
-    delta_pos = p1.position - p2.position
+# ---------------- Collision Detection ---------------- #
+def minimum_image(delta):
     # Apply minimum image convention for periodic boundaries
-    delta_pos[0] -= WIDTH * np.round(delta_pos[0] / WIDTH)
-    delta_pos[1] -= HEIGHT * np.round(delta_pos[1] / HEIGHT)
-    dist = np.linalg.norm(delta_pos)
-    if dist == 0:
-        # Prevent division by zero
-        dist = 1e-8
+    delta[:, 0] -= WIDTH * np.round(delta[:, 0] / WIDTH)
+    delta[:, 1] -= HEIGHT * np.round(delta[:, 1] / HEIGHT)
+    return delta
+
+def find_collision_pairs(positions):
+    # Periodic cell grid with cells of at least one collision diameter, so colliding pairs
+    # are always in the same or in neighbouring cells
+    nx = max(int(WIDTH // (2 * PARTICLE_RADIUS)), 1)
+    ny = max(int(HEIGHT // (2 * PARTICLE_RADIUS)), 1)
+    cx = np.minimum((positions[:, 0] * nx / WIDTH).astype(np.int64), nx - 1)
+    cy = np.minimum((positions[:, 1] * ny / HEIGHT).astype(np.int64), ny - 1)
+
+    # Sort the particles by cell, so the particles of every cell are a contiguous slice. Only the occupied
+    # cells are stored, so memory and time scale with the number of particles and not with the box area
+    cell = cx * ny + cy
+    order = np.argsort(cell, kind='stable')
+    occupied, starts, counts = np.unique(cell[order], return_index=True, return_counts=True)
+
+    # The particles are visited in cell order, then the neighbour lookups are almost sorted
+    cx, cy = cx[order], cy[order]
+    pairs_i = []
+    pairs_j = []
+    for dx in (-1, 0, 1):
+        for dy in (-1, 0, 1):
+            neighbour = ((cx + dx) % nx) * ny + (cy + dy) % ny
+            slot = np.minimum(np.searchsorted(occupied, neighbour), len(occupied) - 1)
+            found = occupied[slot] == neighbour
+            n_candidates = np.where(found, counts[slot], 0)
+            # Expand every particle into one candidate pair per particle in the neighbouring cell
+            i = np.repeat(order, n_candidates)
+            offsets = np.arange(len(i)) - np.repeat(np.cumsum(n_candidates) - n_candidates, n_candidates)
+            j = order[np.repeat(starts[slot], n_candidates) + offsets]
+            keep = i < j
+            pairs_i.append(i[keep])
+            pairs_j.append(j[keep])
+    i = np.concatenate(pairs_i)
+    j = np.concatenate(pairs_j)
+
+    # With fewer than three cells along an axis the same neighbour cell is visited more than once
+    if nx < 3 or ny < 3:
+        key = np.unique(i * len(positions) + j)
+        i, j = key // len(positions), key % len(positions)
+
+    # Narrow phase, the pairs are returned in lexicographic order
+    delta = minimum_image(positions[i] - positions[j])
+    close = np.sum(delta**2, axis=1) < (2 * PARTICLE_RADIUS)**2
+    i, j, delta = i[close], j[close], delta[close]
+    order = np.lexsort((j, i))
+    return i[order], j[order], delta[order]
+
+# ---------------- Collision Handling ---------------- #
+def approaching_pairs(i, j, delta_pos, velocities):
+    # Keep the pairs moving towards each other with their normal vectors and normal velocities
+    dist = np.linalg.norm(delta_pos, axis=1)
+    # Prevent division by zero
+    dist[dist == 0] = 1e-8
     # Normal vector
-    n = delta_pos / dist
-    # Relative velocity
-    delta_v = p1.velocity - p2.velocity
+    n = delta_pos / dist[:, None]
     # Velocity along the normal
-    vn = np.dot(delta_v, n)
-    if vn > 0:
-        # Particles are moving away from each other
-        return
+    vn = np.sum((velocities[i] - velocities[j]) * n, axis=1)
+    # Particles moving away from each other don't collide
+    approaching = vn <= 0
+    return i[approaching], j[approaching], n[approaching], vn[approaching]
+
+def handle_collisions(i, j, delta_pos, velocities, is_red, cooldown, rng):
+    # Elastic impulse exchange and red transmission for all colliding pairs at once,
+    # a particle in several collisions receives the sum of the impulses
+    i, j, n, vn = approaching_pairs(i, j, delta_pos, velocities)
+
     # Compute impulse scalar
     impulse = (2 * vn) / (MASS + MASS)  # Assuming equal mass
     # Update velocities to simulate elastic collision
-    p1.velocity -= impulse * MASS * n
-    p2.velocity += impulse * MASS * n
-
-    # State change
-    if p1.is_red and not p2.is_red:
-        if random.random() < P_RED_ON_COLLISION:
-            p2.is_red = True
-            p2.cooldown_timer = np.random.exponential(scale=COOLDOWN_MEAN)
-    elif p2.is_red and not p1.is_red:
-        if random.random() < P_RED_ON_COLLISION:
-            p1.is_red = True
-            p1.cooldown_timer = np.random.exponential(scale=COOLDOWN_MEAN)
+    np.add.at(velocities, i, -(impulse * MASS)[:, None] * n)
+    np.add.at(velocities, j, (impulse * MASS)[:, None] * n)
+    transmit_red(i, j, is_red, cooldown, rng)
+
+def transmit_red(i, j, is_red, cooldown, rng):
+    # State change, a green particle colliding with a red one turns red
+    transmit = (is_red[i] != is_red[j]) & (rng.uniform(len(i)) < P_RED_ON_COLLISION)
+    infected = np.unique(np.where(is_red[i], j, i)[transmit])
+    is_red[infected] = True
+    cooldown[infected] = rng.cooldown(len(infected))
 
 # ---------------- Periodic Boundary Conditions ---------------- #
-def apply_periodic_boundary(p):
-    p.position[0] = p.position[0] % WIDTH
-    p.position[1] = p.position[1] % HEIGHT
+def apply_periodic_boundary(positions):
+    positions %= (WIDTH, HEIGHT)
 
-# ---------------- Simulation Initialization ---------------- #
-particles = initialize_particles()
-
-# For plotting proportions over time
-time_history = []
-green_history = []
-red_history = []
-
-# ---------------- Visualization Setup ---------------- #
-fig, (ax1, ax2) = plt.subplots(1, 2, figsize=(14, 6))
-
-# ---------------- Particle Animation Setup ---------------- #
-ax1.set_xlim(0, WIDTH)
-ax1.set_ylim(0, HEIGHT)
-ax1.set_aspect('equal')
-ax1.set_title('Particle Simulation')
-particles_plot = ax1.scatter([], [], s=(PARTICLE_RADIUS*800), c=[], facecolors='k', edgecolors='k')
-
-# ---------------- Proportion Plot Setup ---------------- #
-ax2.set_xlim(0, MAX_TIME)
-ax2.set_ylim(0, 1)
-line_green, = ax2.plot([], [], 'g-', label='Green')
-line_red, = ax2.plot([], [], 'r-', label='Red')
-ax2.set_xlabel('Time')
-ax2.set_ylabel('Proportion')
-ax2.set_title('Proportion of Particles')
-ax2.legend()
-ax2.grid(True)
-
-# ---------------- Animation Functions ---------------- #
-def init():
-    # Initialize scatter plot with empty data but correct shape
-    particles_plot.set_offsets(np.empty((0, 2)))  # 2D empty array
-    particles_plot.set_color([])  # Empty color list
-    particles_plot.set_facecolors([])  # Empty face color list
-
-    # Initialize proportion plot
-    time_history.clear()
-    green_history.clear()
-    red_history.clear()
-    line_green.set_data([], [])
-    line_red.set_data([], [])
-
-    return particles_plot, line_green, line_red
-
-def animate(frame):
-    global particles, time_history, green_history, red_history
-    current_time = frame * DT
-    if current_time > MAX_TIME:
-        anim.event_source.stop()
+# ---------------- Event-Driven Engine ---------------- #
+class EventDrivenEngine:
+    # Exact hard-sphere dynamics: pair collisions, cell crossings and cooldown expiries are predicted and kept
+    # in a priority queue, the state jumps from event to event. The particles are kept in the periodic cell grid
+    # of find_collision_pairs, collisions are only predicted against the 3x3 neighbouring cells, and a particle
+    # entering a cell is predicted against the cells which became its neighbours, so every event costs O(1).
+    # Events are invalidated lazily, every particle carries a counter which is increased whenever its velocity
+    # changes, and an event is only executed if the counters stored with it are still current.
+    COLLISION, EXPIRY, CROSSING = 0, 1, 2
+    NEIGHBOURS = [(dx, dy) for dx in (-1, 0, 1) for dy in (-1, 0, 1)]
+    # Cells which become neighbours when entering the next cell along an axis in a direction
+    ENTERED = {(axis, direction): [(direction, d) if axis == 0 else (d, direction) for d in (-1, 0, 1)]
+               for axis in (0, 1) for direction in (-1, 1)}
+
+    def __init__(self, positions, velocities, is_red, cooldown, rng):
+        # The state arrays are updated in place at the end of every advance
+        self.rng = rng
+        self.positions = positions
+        self.velocities = velocities
+        self.is_red = is_red
+        self.cooldown = cooldown
+        self.t = 0.0
+        self.n = len(positions)
+        self.counts = [0] * self.n
+        self.red_counts = [0] * self.n
+        self.expiry = np.where(is_red, cooldown, np.inf)
+        self.queue = []
+        self.seq = 0
+        self.n_collisions = 0
+
+        # Between two advances the events work on one list per axis, scalar access to numpy arrays is slow.
+        # Particles only move when they take part in an event, so every position refers to its own time
+        self.pos = [positions[:, axis].tolist() for axis in (0, 1)]
+        self.vel = [velocities[:, axis].tolist() for axis in (0, 1)]
+        self.times = [0.0] * self.n
+
+        # Cell of every particle and the particles of every occupied cell
+        self.shape = (max(int(WIDTH // (2 * PARTICLE_RADIUS)), 1), max(int(HEIGHT // (2 * PARTICLE_RADIUS)), 1))
+        self.cell_size = (WIDTH / self.shape[0], HEIGHT / self.shape[1])
+        self.cells = [np.minimum((positions[:, axis] / self.cell_size[axis]).astype(np.int64),
+                                 self.shape[axis] - 1).tolist() for axis in (0, 1)]
+        self.members = {}
+        for i in range(self.n):
+            self.members.setdefault(self.key(i), set()).add(i)
+
+        # Every pair is predicted once
+        for i in range(self.n):
+            self.predict(i, self.NEIGHBOURS, first=i + 1)
+            self.predict_crossing(i)
+            if is_red[i]:
+                self.push(self.expiry[i], self.EXPIRY, i, -1, self.red_counts[i], 0)
+
+    def push(self, time, kind, i, j, count_i, count_j):
+        heapq.heappush(self.queue, (time, self.seq, kind, i, j, count_i, count_j))
+        self.seq += 1
+
+    def key(self, i):
+        return self.cells[0][i] * self.shape[1] + self.cells[1][i]
+
+    def move(self, i):
+        # Bring particle i to the current time
+        dt = self.t - self.times[i]
+        if dt:
+            self.pos[0][i] += self.vel[0][i] * dt
+            self.pos[1][i] += self.vel[1][i] * dt
+            self.times[i] = self.t
+
+    def predict(self, i, offsets, first=0):
+        # Collision times of particle i with the particles in the cells at the given offsets from its own, the
+        # periodic image of a neighbour follows from the offset, not from its distance
+        self.move(i)
+        (xs, ys), (vxs, vys) = self.pos, self.vel
+        x, y, vx, vy = xs[i], ys[i], vxs[i], vys[i]
+        nx, ny = self.shape
+        for dx, dy in offsets:
+            cx, cy = self.cells[0][i] + dx, self.cells[1][i] + dy
+            members = self.members.get((cx % nx) * ny + cy % ny)
+            if not members:
+                continue
+            shift_x, shift_y = WIDTH * (cx // nx), HEIGHT * (cy // ny)
+            for j in members:
+                if j == i or j < first:
+                    continue
+                self.move(j)
+                rx = x - xs[j] - shift_x
+                ry = y - ys[j] - shift_y
+                ux = vx - vxs[j]
+                uy = vy - vys[j]
+                b = rx * ux + ry * uy
+                if b >= 0:
+                    continue
+                u2 = ux**2 + uy**2
+                c = rx**2 + ry**2 - (2 * PARTICLE_RADIUS)**2
+                disc = b**2 - u2 * c
+                if disc < 0:
+                    continue
+                dt = 0.0 if c < 0 else (-b - disc**0.5) / u2
+                self.push(self.t + dt, self.COLLISION, i, j, self.counts[i], self.counts[j])
+
+    def predict_crossing(self, i):
+        # Time at which particle i leaves its cell, the axis along which it leaves is stored as partner
+        dt, axis = np.inf, -1
+        for k in (0, 1):
+            v = self.vel[k][i]
+            if v == 0:
+                continue
+            edge = (self.cells[k][i] + (v > 0)) * self.cell_size[k]
+            dt_k = (edge - self.pos[k][i]) / v
+            if dt_k < dt:
+                dt, axis = dt_k, k
+        if axis >= 0:
+            self.push(self.times[i] + max(dt, 0.0), self.CROSSING, i, axis, self.counts[i], 0)
+
+    def cross(self, i, axis):
+        # Move particle i into the next cell, wrapping its position together with the cell index
+        self.move(i)
+        direction = 1 if self.vel[axis][i] > 0 else -1
+        key = self.key(i)
+        self.members[key].discard(i)
+        if not self.members[key]:
+            del self.members[key]
+        cell = self.cells[axis][i] + direction
+        if cell < 0 or cell >= self.shape[axis]:
+            cell %= self.shape[axis]
+            self.pos[axis][i] -= direction * (WIDTH, HEIGHT)[axis]
+        self.cells[axis][i] = cell
+        self.members.setdefault(self.key(i), set()).add(i)
+
+        self.predict_crossing(i)
+        self.predict(i, self.ENTERED[axis, direction])
+
+    def collide(self, i, j):
+        # Exchange the velocity components along the line of centers
+        self.move(i)
+        self.move(j)
+        (xs, ys), (vxs, vys) = self.pos, self.vel
+        dx = xs[i] - xs[j]
+        dy = ys[i] - ys[j]
+        dx -= WIDTH * round(dx / WIDTH)
+        dy -= HEIGHT * round(dy / HEIGHT)
+        dist = max((dx**2 + dy**2)**0.5, 1e-12)
+        vn = ((vxs[i] - vxs[j]) * dx + (vys[i] - vys[j]) * dy) / dist
+        for v, d in ((vxs, dx), (vys, dy)):
+            v[i] -= vn * d / dist
+            v[j] += vn * d / dist
+        self.n_collisions += 1
 
+        # State change, a green particle colliding with a red one turns red
+        if self.is_red[i] != self.is_red[j] and self.rng.uniform(1)[0] < P_RED_ON_COLLISION:
+            k = j if self.is_red[i] else i
+            self.is_red[k] = True
+            self.red_counts[k] += 1
+            self.expiry[k] = self.t + self.rng.cooldown(1)[0]
+            self.push(self.expiry[k], self.EXPIRY, k, -1, self.red_counts[k], 0)
+
+        self.counts[i] += 1
+        self.counts[j] += 1
+        for k in (i, j):
+            self.predict(k, self.NEIGHBOURS)
+            self.predict_crossing(k)
+
+    def advance(self, time):
+        # Execute all events up to the given time, then bring all particles to it and write the state arrays
+        while self.queue and self.queue[0][0] <= time:
+            event_time, _, kind, i, j, count_i, count_j = heapq.heappop(self.queue)
+            if kind == self.EXPIRY:
+                if self.red_counts[i] == count_i and self.is_red[i]:
+                    self.t = event_time
+                    self.is_red[i] = False
+                    self.red_counts[i] += 1
+                    self.expiry[i] = np.inf
+            elif self.counts[i] == count_i and (kind == self.CROSSING or self.counts[j] == count_j):
+                self.t = event_time
+                if kind == self.COLLISION:
+                    self.collide(i, j)
+                else:
+                    self.cross(i, j)
+        self.t = time
+        for axis in (0, 1):
+            self.velocities[:, axis] = self.vel[axis]
+            self.positions[:, axis] = self.pos[axis]
+        self.positions += self.velocities * (time - np.array(self.times))[:, None]
+        self.pos = [self.positions[:, axis].tolist() for axis in (0, 1)]
+        self.times = [time] * self.n
+        self.cooldown[:] = np.where(self.is_red, self.expiry - self.t, 0.0)
+
+# ---------------- Time Stepping ---------------- #
+def step(positions, velocities, is_red, cooldown, rng):
     # Update positions
-    for p in particles:
-        p.position += p.velocity * DT
-        apply_periodic_boundary(p)
+    positions += velocities * DT
+    apply_periodic_boundary(positions)
 
     # Detect and handle collisions
-    # Using a simple pairwise check; for better performance with many particles, consider spatial partitioning
-    for i in range(N_PARTICLES):
-        for j in range(i+1, N_PARTICLES):
-            p1 = particles[i]
-            p2 = particles[j]
-            delta_pos = p1.position - p2.position
-            # Apply minimum image convention for periodic boundaries
-            delta_pos[0] -= WIDTH * np.round(delta_pos[0] / WIDTH)
-            delta_pos[1] -= HEIGHT * np.round(delta_pos[1] / HEIGHT)
-            dist = np.linalg.norm(delta_pos)
-            if dist < 2 * PARTICLE_RADIUS:
-                handle_collision(p1, p2)
+    handle_collisions(*find_collision_pairs(positions), velocities, is_red, cooldown, rng)
 
     # Update cooldown timers and handle state transitions
-    for p in particles:
-        if p.is_red:
-            p.cooldown_timer -= DT
-            if p.cooldown_timer <= 0:
-                p.is_red = False
-                p.cooldown_timer = 0.0
-
-    # Record proportions
-    n_red = sum(p.is_red for p in particles)
-    n_green = N_PARTICLES - n_red
-    time_history.append(current_time)
-    green_history.append(n_green / N_PARTICLES)
-    red_history.append(n_red / N_PARTICLES)
-
-    # Update particle plot
-    x = [p.position[0] for p in particles]
-    y = [p.position[1] for p in particles]
-    colors = ['red' if p.is_red else 'green' for p in particles]
-    particles_plot.set_offsets(np.c_[x, y])
-    particles_plot.set_facecolors(colors)
-    particles_plot.set_color(colors)
-    
-
-    # Update proportion plot
-    line_green.set_data(time_history, green_history)
-    line_red.set_data(time_history, red_history)
-    ax2.set_xlim(0, max(MAX_TIME, current_time + DT))
-
-    return particles_plot, line_green, line_red
-
-# ---------------- Run Animation ---------------- #
-anim = animation.FuncAnimation(
-    fig, animate, init_func=init,
-    frames=int(MAX_TIME / DT), interval=20, blit=True
-)
-
-plt.tight_layout()
-plt.show()
+    cooldown[is_red] -= DT
+    expired = is_red & (cooldown <= 0)
+    is_red[expired] = False
+    cooldown[expired] = 0.0
+
+# ---------------- Domain Decomposition ---------------- #
+# State of a worker process: views of the shared particle arrays and the strip edges
+shared = {}
+
+def attach_shared(names, n, edges):
+    shared['blocks'] = [shared_memory.SharedMemory(name=name) for name in names]
+    arrays = shared_arrays(shared['blocks'], n)
+    shared['positions'], shared['velocities'], shared['is_red'], shared['cooldown'], shared['v_old'] = arrays
+    shared['edges'] = edges
+
+def shared_arrays(blocks, n):
+    positions = np.ndarray((n, 2), dtype=np.float64, buffer=blocks[0].buf)
+    velocities = np.ndarray((n, 2), dtype=np.float64, buffer=blocks[1].buf)
+    is_red = np.ndarray((n,), dtype=np.bool_, buffer=blocks[2].buf)
+    cooldown = np.ndarray((n,), dtype=np.float64, buffer=blocks[3].buf)
+    v_old = np.ndarray((n, 2), dtype=np.float64, buffer=blocks[4].buf)
+    return positions, velocities, is_red, cooldown, v_old
+
+def drift_chunk(chunk):
+    # Update and wrap the positions of a contiguous range of particles, keep their velocities before the
+    # collisions and sort them into strips: every particle belongs to the strip containing it and to the halo
+    # of a neighbouring strip if it is closer than 2 * PARTICLE_RADIUS to the common edge
+    start, end = chunk
+    positions = shared['positions'][start:end]
+    positions += shared['velocities'][start:end] * DT
+    apply_periodic_boundary(positions)
+    shared['v_old'][start:end] = shared['velocities'][start:end]
+
+    edges = shared['edges']
+    strips = len(edges) - 1
+    x = positions[:, 0]
+    index = np.arange(start, end)
+    strip = np.clip(np.searchsorted(edges, x, side='right') - 1, 0, strips - 1)
+    own = split_strips(strip, index, strips)
+    if strips == 1:
+        return own, [index[:0]]
+    right = edges[strip + 1] - x <= 2 * PARTICLE_RADIUS
+    left = x - edges[strip] < 2 * PARTICLE_RADIUS
+    neighbour = np.concatenate([(strip[right] + 1) % strips, (strip[left] - 1) % strips])
+    halo = split_strips(neighbour, np.concatenate([index[right], index[left]]), strips)
+    return own, halo
+
+def split_strips(strip, index, strips):
+    # Lists of the indices per strip, in the order of index
+    order = np.argsort(strip, kind='stable')
+    bounds = np.searchsorted(strip[order], np.arange(strips + 1))
+    return [index[order[bounds[s]:bounds[s + 1]]] for s in range(strips)]
+
+def strip_collisions(task):
+    # Collisions of the particles of one strip, searched on the strip and its halo only. The normal velocities
+    # use the velocities before the collisions and the impulses are added to the particles of the strip only,
+    # in the order of the serial step, so no two workers write the same particle. The pairs whose first
+    # particle lies in the strip are returned for the red transmission
+    own, halo = task
+    local = np.union1d(own, halo)
+    mine = np.isin(local, own, assume_unique=True)
+    i, j, delta = find_collision_pairs(shared['positions'][local])
+    i, j, n, vn = approaching_pairs(i, j, delta, shared['v_old'][local])
+
+    impulse = (2 * vn) / (MASS + MASS)
+    mine_i, mine_j = mine[i], mine[j]
+    np.add.at(shared['velocities'], local[i[mine_i]], -(impulse * MASS)[mine_i, None] * n[mine_i])
+    np.add.at(shared['velocities'], local[j[mine_j]], (impulse * MASS)[mine_j, None] * n[mine_j])
+    return local[i[mine_i]], local[j[mine_i]]
+
+def cooldown_chunk(chunk):
+    # Update the cooldown timers of a contiguous range of particles and count its red particles
+    start, end = chunk
+    is_red = shared['is_red'][start:end]
+    cooldown = shared['cooldown'][start:end]
+    cooldown[is_red] -= DT
+    expired = is_red & (cooldown <= 0)
+    is_red[expired] = False
+    cooldown[expired] = 0.0
+    return np.count_nonzero(is_red)
+
+class ParallelEngine:
+    # Fixed time steps on worker processes sharing the particle arrays. Drift, pair search, impulses and
+    # cooldowns run in parallel on chunks of particles and on vertical strips of the box. Only the red
+    # transmission of the colliding pairs runs in the main process, on the pairs sorted like in the serial
+    # pair search, so the random draws and the result match the serial step for the same seed.
+    def __init__(self, positions, velocities, is_red, cooldown, rng, workers):
+        n = len(positions)
+        strips = max(min(workers, int(WIDTH // (2 * PARTICLE_RADIUS))), 1)
+        self.edges = np.linspace(0, WIDTH, strips + 1)
+        self.strips = strips
+        self.chunks = [(k * n // workers, (k + 1) * n // workers) for k in range(workers)]
+        self.rng = rng
+
+        arrays = (positions, velocities, is_red, cooldown, velocities)
+        self.pool = None
+        self.blocks = []
+        try:
+            for a in arrays:
+                self.blocks.append(shared_memory.SharedMemory(create=True, size=max(a.nbytes, 1)))
+            self.positions, self.velocities, self.is_red, self.cooldown, v_old = shared_arrays(self.blocks, n)
+            for array, view in zip(arrays, shared_arrays(self.blocks, n)):
+                view[:] = array
+            self.pool = multiprocessing.Pool(workers, initializer=attach_shared,
+                                             initargs=([block.name for block in self.blocks], n, self.edges))
+        except BaseException:
+            self.close(terminate=True)
+            raise
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        # After an error or an interrupt the workers may be busy, so they are stopped instead of joined
+        self.close(terminate=exc[0] is not None)
+
+    def step(self):
+        # Returns the number of red particles after the step
+        chunks = self.pool.map(drift_chunk, self.chunks)
+        tasks = [(np.concatenate([own[s] for own, halo in chunks]), np.concatenate([halo[s] for own, halo in chunks]))
+                 for s in range(self.strips)]
+        pairs = self.pool.map(strip_collisions, tasks)
+        i = np.concatenate([p[0] for p in pairs])
+        j = np.concatenate([p[1] for p in pairs])
+        order = np.lexsort((j, i))
+        transmit_red(i[order], j[order], self.is_red, self.cooldown, self.rng)
+        return sum(self.pool.map(cooldown_chunk, self.chunks))
+
+    def close(self, terminate=False):
+        # Stop the workers and release the shared memory, calling it again does nothing
+        if self.pool is not None:
+            if terminate:
+                self.pool.terminate()
+            else:
+                self.pool.close()
+            self.pool.join()
+            self.pool = None
+        # The views on the blocks have to be gone before a block can be closed
+        self.positions = self.velocities = self.is_red = self.cooldown = None
+        for block in self.blocks:
+            block.close()
+            block.unlink()
+        self.blocks = []
+
+# ---------------- Headless Run ---------------- #
+def run_headless(positions, velocities, is_red, cooldown, rng, stats_file=STATS_FILE, stats_stride=STATS_STRIDE,
+                 snapshot_file=None, snapshot_stride=SNAPSHOT_STRIDE, workers=WORKERS):
+    # Advance the model to MAX_TIME as fast as possible. The proportions are written into a preallocated
+    # array on disk, the optional snapshots hold the time, positions and colours for a later replay.
+    n_steps = int(MAX_TIME / DT)
+    n = len(positions)
+    stats = np.lib.format.open_memmap(stats_file, mode='w+', dtype=np.float64,
+                                      shape=(n_steps // stats_stride + 1, 3))
+    snapshots = None
+    if snapshot_file is not None:
+        dtype = np.dtype([('time', np.float64), ('positions', np.float32, (n, 2)), ('is_red', np.bool_, (n,))])
+        snapshots = np.lib.format.open_memmap(snapshot_file, mode='w+', dtype=dtype,
+                                              shape=(n_steps // snapshot_stride + 1,))
+    engine = EventDrivenEngine(positions, velocities, is_red, cooldown, rng) if EVENT_DRIVEN else None
+    parallel = None
+    state = (positions, velocities, is_red, cooldown)
+    if engine is None and workers > 1:
+        parallel = ParallelEngine(positions, velocities, is_red, cooldown, rng, workers)
+        positions, velocities, is_red, cooldown = parallel.positions, parallel.velocities, parallel.is_red, parallel.cooldown
+
+    try:
+        for k in range(n_steps + 1):
+            # The parallel step counts the red particles per chunk, the other engines are counted here
+            n_red = None
+            if k > 0:
+                if engine is not None:
+                    engine.advance(k * DT)
+                elif parallel is not None:
+                    n_red = parallel.step()
+                else:
+                    step(positions, velocities, is_red, cooldown, rng)
+
+            if k % stats_stride == 0:
+                if n_red is None:
+                    n_red = np.count_nonzero(is_red)
+                stats[k // stats_stride] = (k * DT, (n - n_red) / n, n_red / n)
+            if snapshots is not None and k % snapshot_stride == 0:
+                snapshots[k // snapshot_stride] = (k * DT, positions, is_red)
+
+        if parallel is not None:
+            # Copy the final state back into the arrays of the caller
+            for array, view in zip(state, (positions, velocities, is_red, cooldown)):
+                array[:] = view
+    except BaseException:
+        # Workers and shared memory are released also after an error or an interrupt
+        if parallel is not None:
+            positions = velocities = is_red = cooldown = None
+            parallel.close(terminate=True)
+        raise
+    if parallel is not None:
+        positions = velocities = is_red = cooldown = None
+        parallel.close()
+
+    stats.flush()
+    if snapshots is not None:
+        snapshots.flush()
+    return stats
+
+# ---------------- Animation ---------------- #
+def run_animation(positions, velocities, is_red, cooldown, rng):
+    if EVENT_DRIVEN:
+        engine = EventDrivenEngine(positions, velocities, is_red, cooldown, rng)
+
+    # For plotting proportions over time
+    time_history = []
+    green_history = []
+    red_history = []
+
+    # ---------------- Visualization Setup ---------------- #
+    fig, (ax1, ax2) = plt.subplots(1, 2, figsize=(14, 6))
+
+    # ---------------- Particle Animation Setup ---------------- #
+    ax1.set_xlim(0, WIDTH)
+    ax1.set_ylim(0, HEIGHT)
+    ax1.set_aspect('equal')
+    ax1.set_title('Particle Simulation')
+    particles_plot = ax1.scatter([], [], s=(PARTICLE_RADIUS*800), c=[], facecolors='k', edgecolors='k')
+
+    # ---------------- Proportion Plot Setup ---------------- #
+    ax2.set_xlim(0, MAX_TIME)
+    ax2.set_ylim(0, 1)
+    line_green, = ax2.plot([], [], 'g-', label='Green')
+    line_red, = ax2.plot([], [], 'r-', label='Red')
+    ax2.set_xlabel('Time')
+    ax2.set_ylabel('Proportion')
+    ax2.set_title('Proportion of Particles')
+    ax2.legend()
+    ax2.grid(True)
+
+    # ---------------- Animation Functions ---------------- #
+    def init():
+        # Initialize scatter plot with empty data but correct shape
+        particles_plot.set_offsets(np.empty((0, 2)))  # 2D empty array
+        particles_plot.set_color([])  # Empty color list
+        particles_plot.set_facecolors([])  # Empty face color list
+
+        # Initialize proportion plot
+        time_history.clear()
+        green_history.clear()
+        red_history.clear()
+        line_green.set_data([], [])
+        line_red.set_data([], [])
+
+        return particles_plot, line_green, line_red
+
+    def animate(frame):
+        current_time = frame * DT
+        if current_time > MAX_TIME:
+            anim.event_source.stop()
+
+        if EVENT_DRIVEN:
+            # Sample the event-driven dynamics at the frame time
+            engine.advance(current_time)
+        else:
+            step(positions, velocities, is_red, cooldown, rng)
+
+        # Record proportions
+        n_red = np.count_nonzero(is_red)
+        n_green = N_PARTICLES - n_red
+        time_history.append(current_time)
+        green_history.append(n_green / N_PARTICLES)
+        red_history.append(n_red / N_PARTICLES)
+
+        # Update particle plot
+        colors = np.where(is_red, 'red', 'green')
+        particles_plot.set_offsets(positions)
+        particles_plot.set_facecolors(colors)
+        particles_plot.set_color(colors)
+
+
+        # Update proportion plot
+        line_green.set_data(time_history, green_history)
+        line_red.set_data(time_history, red_history)
+        ax2.set_xlim(0, max(MAX_TIME, current_time + DT))
+
+        return particles_plot, line_green, line_red
+
+    # ---------------- Run Animation ---------------- #
+    anim = animation.FuncAnimation(
+        fig, animate, init_func=init,
+        frames=int(MAX_TIME / DT), interval=20, blit=True
+    )
+
+    plt.tight_layout()
+    plt.show()
+
+# ---------------- Simulation Initialization ---------------- #
+if __name__ == '__main__':
+    rng = RandomStream(SEED)
+    positions, velocities, is_red, cooldown = initialize_particles(rng)
+    if HEADLESS:
+        run_headless(positions, velocities, is_red, cooldown, rng, STATS_FILE, STATS_STRIDE,
+                     SNAPSHOT_FILE, SNAPSHOT_STRIDE, WORKERS)
+    else:
+        run_animation(positions, velocities, is_red, cooldown, rng)